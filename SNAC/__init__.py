@@ -5,7 +5,10 @@ import sys
 import time
 import json
 import hashlib
+import threading
+import collections
 import SNAC.data
+import SNAC.data_sqlite
 import SNAC.http
 import SNAC.webfinger
 import SNAC.activitypub
@@ -29,12 +32,38 @@ _server = {
     "address":              "0.0.0.0",
     "port":                 10000,
     "layout":               SNAC.data.layout_version,
+    "storage":              "files",
+    "encoding":             "json",
     "dbglevel":             0,
     "queue_retry_minutes":  2,
     "queue_retry_max":      10,
+    "queue_retry_backoff":  2,
+    "queue_retry_jitter":   0.2,
+    "queue_retry_max_hours": 12,
+    "dead_letter_days":     30,
     "cssurls":              [""],
     "max_timeline_entries": 256,
-    "timeline_purge_days":  120
+    "timeline_cache_mb":    16,
+    "timeline_purge_days":  120,
+    "timeline_buckets":     "",
+    "actor_cache_entries":  4096,
+    "actor_ttl_hours":      36,
+    "actor_refresh_threads": 4,
+    "actor_negative_minutes": { "404": 60, "410": 10080, "5xx": 10, "timeout": 5 },
+    "object_cache_entries": 1024,
+    "object_ttl_minutes":   { "Note": 10, "Question": 1, "actor": 0, "default": 5 },
+    "key_cache_entries":    1024,
+    "signature_cache_entries": 4096,
+    "signature_cache_minutes": 10,
+    "crypto_threads":       0,
+    "delivery_threads":     8,
+    "input_threads":        4,
+    "ancestor_threads":     4,
+    "ancestor_depth":       16,
+    "seen_entries":         16384,
+    "delivery_host_connections": 2,
+    "circuit_failures":     10,
+    "circuit_probe_minutes": 5
 }
 
 _key = {
@@ -53,6 +82,68 @@ class server:
 
         self.data       = SNAC.data
         self.webfinger  = SNAC.webfinger
+        self.activitypub = SNAC.activitypub
+
+        # the actor cache, shared by all users
+        self.actor_cache = collections.OrderedDict()
+        self.actor_lock  = threading.Lock()
+        self.actor_stats = { "hits": 0, "misses": 0, "stale": 0, "refreshes": 0,
+                             "failures": 0, "negative": 0 }
+
+        # actors that failed, as actor: (retry time, status)
+        self.actor_negative = {}
+
+        # the remote object cache, shared by all users
+        self.object_cache = collections.OrderedDict()
+        self.object_lock  = threading.Lock()
+        self.object_stats = { "hits": 0, "revalidated": 0, "misses": 0 }
+
+        # to wake up the delivery when something is enqueued
+        self.queue_cond = threading.Condition()
+        self.queue_seq  = 0
+
+        # the delivery pool: items by host, connections by host,
+        # recipients being delivered to, queue items taken (by user directory and id)
+        self.delivery_pending = collections.OrderedDict()
+        self.delivery_taken   = set()
+        self.delivery_hosts   = {}
+        self.delivery_dests   = set()
+        self.delivery_cond    = threading.Condition()
+        self.delivery_workers = 0
+        self.delivery_stats   = { "in_flight": 0, "completed": 0, "failed": 0, "saved": 0 }
+
+        # the input pool: received messages, actors being processed
+        self.input_pending = []
+        self.input_taken   = set()
+        self.input_actors  = set()
+        self.input_cond    = threading.Condition()
+        self.input_workers = 0
+        self.input_stats   = { "in_flight": 0, "processed": 0, "failed": 0 }
+
+        # the activities recently received, as "uid actor id", loaded when needed,
+        # and the ones still being processed
+        self.seen       = None
+        self.seen_lines = 0
+        self.seen_taken = set()
+        self.seen_lock  = threading.Lock()
+        self.seen_stats = { "hits": 0, "misses": 0 }
+
+        # the ancestor fetcher: pending, children by fetched id, hosts being fetched
+        self.ancestor_pending  = []
+        self.ancestor_fetching = {}
+        self.ancestor_hosts    = set()
+        self.ancestor_cond     = threading.Condition()
+        self.ancestor_workers  = 0
+        self.ancestor_stats    = { "fetched": 0, "failed": 0 }
+
+        # hosts failing, as host: { failures, circuit open until, probing }
+        self.host_health = {}
+
+        # actors to be refreshed in the background, and
+        # the users whose follower roster waits for each one
+        self.actor_refresh_queue = collections.deque()
+        self.actor_refreshing    = {}
+        self.actor_refreshers    = 0
 
         self.ok, self.error = self.data.open_server(self)
 
@@ -102,7 +193,7 @@ class snac:
         self.user       = _user
         self.key        = _key
 
-        self.data           = SNAC.data
+        self.data           = server.data
         self.http           = SNAC.http
         self.webfinger      = SNAC.webfinger
         self.activitypub    = SNAC.activitypub
@@ -4,6 +4,7 @@ import sys
 import os
 import time
 import json
+import urllib.parse
 
 def usage():
     print("snac - A simple, minimalistic ActivityPub instance")
@@ -14,6 +15,10 @@ def usage():
     print("init {basedir} {host}               Initializes the database") 
     print("check {basedir} [{uid}]          Checks the database")
     print("purge {basedir} [{uid}]          Purges old data")
+    print("reindex {basedir} [{uid}]        Rebuilds the timeline index")
+    print("migrate {basedir} [{uid}]        Imports layout v1 data into SQLite")
+    print("convert {basedir} [{uid}]        Rewrites data in the configured encoding/buckets")
+    print("queue-stats {basedir} [{uid}]    Shows the output queues and dead letters")
     print("adduser {basedir} [{uid}]        Adds a new user")
     print("httpd {basedir} [[host:]port]    Starts the HTTPD daemon")
 
@@ -97,6 +102,109 @@ def main():
 
         return 0
 
+    if cmd == "reindex":
+
+        if len(args) > 0:
+            uid = args.pop()
+
+            snac = SNAC.snac(srv, uid)
+
+            snac.data.timeline_index_rebuild(snac)
+
+        else:
+            for snac in srv.users():
+                snac.data.timeline_index_rebuild(snac)
+
+        return 0
+
+    if cmd == "migrate":
+        import SNAC.data_sqlite
+
+        if len(args) > 0:
+            snacs = [SNAC.snac(srv, args.pop())]
+        else:
+            snacs = srv.users()
+
+        for snac in snacs:
+            n = SNAC.data_sqlite.migrate(snac)
+            print("%s: %s" % (snac.user["uid"], n))
+
+        return 0
+
+    if cmd == "convert":
+
+        if len(args) > 0:
+            snacs = [SNAC.snac(srv, args.pop())]
+        else:
+            snacs = srv.users()
+
+        snac = None
+
+        for snac in snacs:
+            n = snac.data.convert(snac)
+            print("%s: %s" % (snac.user["uid"], n))
+
+        # the actor cache is shared by all users
+        if snac is not None:
+            print("actors: %d" % snac.data.convert_actors(snac))
+
+        return 0
+
+    if cmd == "queue-stats":
+
+        if len(args) > 0:
+            snacs = [SNAC.snac(srv, args.pop())]
+        else:
+            snacs = srv.users()
+
+        # age histogram buckets, in seconds
+        ages = [(60, "1m"), (600, "10m"), (3600, "1h"), (6 * 3600, "6h"), (24 * 3600, "1d")]
+        t    = time.time()
+
+        for snac in snacs:
+            hist  = [0] * (len(ages) + 1)
+            hosts = {}
+            due   = 0
+            n     = 0
+
+            for d, item in snac.data.queue_items(snac):
+                n += 1
+
+                if d <= t:
+                    due += 1
+
+                age = t - item.get("queued", d)
+                i   = 0
+
+                while i < len(ages) and age >= ages[i][0]:
+                    i += 1
+
+                hist[i] += 1
+
+                host = urllib.parse.urlparse(item.get("inbox") or item["actor"]).netloc
+                hosts.setdefault(host, [0, 0])[0] += 1
+
+            dead = 0
+
+            for d, item in snac.data.dead_letters(snac):
+                dead += 1
+
+                host = urllib.parse.urlparse(item.get("inbox") or item["actor"]).netloc
+                hosts.setdefault(host, [0, 0])[1] += 1
+
+            print("%s: %d queued, %d due, %d dead letters" % (snac.user["uid"], n, due, dead))
+
+            if n:
+                l = ["<%s %d" % (ages[i][1], hist[i]) for i in range(len(ages))]
+                l.append(">=%s %d" % (ages[-1][1], hist[-1]))
+
+                print("  age: %s" % ", ".join(l))
+
+            for host in sorted(hosts, key=lambda h: -sum(hosts[h])):
+                print("  %s: %d queued, %d dead letters" % (host, hosts[host][0], hosts[host][1]))
+
+        return 0
+
     if cmd == "adduser":
         import SNAC.utils
 
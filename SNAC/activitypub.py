@@ -5,6 +5,8 @@ import json
 import time
 import datetime
 import re
+import threading
+import urllib.parse
 
 public_address = "https://www.w3.org/ns/activitystreams#Public"
 
@@ -50,44 +52,371 @@ def send_to_actor(snac, actor, msg):
     return status, body
 
 
+def deliver(snac, q_elem):
+    """ delivers an output queue item """
+
+    actor   = q_elem["actor"]
+    msg     = q_elem["object"]
+    retries = q_elem["retries"]
+    inbox   = q_elem.get("inbox")
+    shared  = q_elem.get("shared", False)
+    queued  = q_elem.get("queued")
+
+    # strip snac metadata
+    try:
+        del(msg["_snac"])
+    except:
+        pass
+
+    # send (directly, if the inbox is already known)
+    if inbox is not None:
+        status, body = send_to_inbox(snac, inbox, msg)
+    else:
+        status, body = send_to_actor(snac, actor, msg)
+
+    if status < 200 or status >= 300:
+        deliver_failed(snac, q_elem, status)
+
+    return status
+
+
+def deliver_failed(snac, q_elem, status):
+    """ re-enqueues an output queue item that could not be delivered, or gives up """
+
+    actor   = q_elem["actor"]
+    msg     = q_elem["object"]
+    retries = q_elem["retries"]
+    inbox   = q_elem.get("inbox")
+    shared  = q_elem.get("shared", False)
+    queued  = q_elem.get("queued")
+
+    # too much tries?
+    if retries > snac.server["queue_retry_max"]:
+        snac.log("giving up for %s %s" % (actor, status))
+        snac.data.add_to_dead_letters(snac, q_elem, status)
+    else:
+        snac.log("requeueing for %s %s" % (actor, status))
+
+        if shared:
+            # a shared inbox is for many actors: keep it
+            snac.data.enqueue_output(snac, actor, msg, retries + 1, inbox, shared, queued)
+        else:
+            # reenqueue (resolving the actor again, in case it moved)
+            snac.data.enqueue_output(snac, actor, msg, retries + 1, queued=queued)
+
+
+""" delivery pool """
+
+def _delivery_dest(q_elem):
+    """ returns the destination of a queue item and its host """
+
+    dest = q_elem.get("inbox") or q_elem["actor"]
+
+    return dest, urllib.parse.urlparse(dest).netloc
+
+
+def _host_available(srv, host):
+    """ checks if a host can be sent to (with the delivery lock held) """
+
+    h = srv.host_health.get(host)
+
+    # circuit closed?
+    if h is None or h["until"] == 0:
+        return True
+
+    # open: only one probe, and only when the time comes
+    return not h["probing"] and h["until"] <= time.time()
+
+
+def _host_result(srv, host, ok):
+    """ takes note of the result of a delivery (with the delivery lock held) """
+
+    h = srv.host_health.get(host)
+
+    if ok:
+        if h is not None:
+            if h["until"]:
+                srv.log("host %s is back, circuit closed" % host)
+
+            del srv.host_health[host]
+
+        return
+
+    if h is None:
+        h = { "failures": 0, "until": 0, "probing": False }
+        srv.host_health[host] = h
+
+    h["failures"] += 1
+    h["probing"]   = False
+
+    if h["until"] or h["failures"] >= srv.config["circuit_failures"]:
+        if h["until"] == 0:
+            srv.log("host %s failed %d times, circuit open" % (host, h["failures"]))
+
+        h["until"] = time.time() + 60 * srv.config["circuit_probe_minutes"]
+
+
+def host_health(srv):
+    """ returns the hosts with failures, as host: (state, failures, next probe time) """
+
+    d = {}
+
+    with srv.delivery_cond:
+        for host, h in srv.host_health.items():
+            if h["until"] == 0:
+                state = "failing"
+            elif h["probing"]:
+                state = "probing"
+            else:
+                state = "open"
+
+            d[host] = (state, h["failures"], h["until"])
+
+    return d
+
+
+def _delivery_park(srv):
+    """ takes the pending items of the hosts that are down (with the delivery lock held) """
+
+    park = []
+    t    = time.time()
+
+    for host in list(srv.delivery_pending.keys()):
+        h = srv.host_health.get(host)
+
+        # not down, or about to be probed?
+        if h is None or h["until"] == 0 or h["probing"] or h["until"] <= t:
+            continue
+
+        for snac, qid, q_elem in srv.delivery_pending.pop(host):
+            park.append((snac, qid, h["until"]))
+
+    return park
+
+
+def _delivery_next(srv):
+    """ takes the next deliverable item (with the delivery lock held) """
+
+    for host, items in srv.delivery_pending.items():
+        # too many connections to this host?
+        if srv.delivery_hosts.get(host, 0) >= srv.config["delivery_host_connections"]:
+            continue
+
+        # parked, as the host is down?
+        if not _host_available(srv, host):
+            continue
+
+        for i, (snac, qid, q_elem) in enumerate(items):
+            dest, host = _delivery_dest(q_elem)
+
+            # keep the order for each recipient
+            if dest in srv.delivery_dests:
+                continue
+
+            del items[i]
+
+            # give the other hosts a chance
+            if len(items):
+                srv.delivery_pending.move_to_end(host)
+            else:
+                del srv.delivery_pending[host]
+
+            srv.delivery_hosts[host] = srv.delivery_hosts.get(host, 0) + 1
+            srv.delivery_dests.add(dest)
+
+            # is this the probe of a host that was down?
+            if host in srv.host_health and srv.host_health[host]["until"]:
+                srv.host_health[host]["probing"] = True
+
+            return snac, qid, q_elem
+
+    return None, None, None
+
+
+def _delivery_worker(srv):
+    """ delivery thread: sends the pending items """
+
+    while True:
+        with srv.delivery_cond:
+            park = _delivery_park(srv)
+
+            snac, qid, q_elem = _delivery_next(srv)
+
+            if snac is None and len(park) == 0:
+                srv.delivery_workers -= 1
+                srv.delivery_cond.notify_all()
+                return
+
+            if snac is not None:
+                srv.delivery_stats["in_flight"] += 1
+
+        # the items of hosts that are down wait in the queue until the next
+        # probe (not counted as a retry), instead of in memory
+        for p_snac, p_qid, due in park:
+            p_snac.data.queue_postpone(p_snac, p_qid, due)
+
+            with srv.delivery_cond:
+                srv.delivery_taken.discard((p_snac.basedir, p_qid))
+
+        if snac is None:
+            continue
+
+        try:
+            status = deliver(snac, q_elem)
+            done   = True
+        except:
+            snac.log("error delivering to %s" % q_elem["actor"])
+            status = 500
+
+            # retried as any other failure, if possible
+            try:
+                deliver_failed(snac, q_elem, status)
+                done = True
+            except:
+                done = False
+
+        if done:
+            # sent (or re-enqueued for a retry, or given up): out of the queue
+            snac.data.queue_done(snac, qid)
+        else:
+            # kept in the queue, for later
+            retries = q_elem["retries"] + 1
+            snac.data.queue_postpone(snac, qid, time.time() + snac.data.queue_retry_delay(snac, retries))
+
+        dest, host = _delivery_dest(q_elem)
+
+        with srv.delivery_cond:
+            srv.delivery_stats["in_flight"] -= 1
+            srv.delivery_dests.discard(dest)
+            srv.delivery_taken.discard((snac.basedir, qid))
+
+            srv.delivery_hosts[host] -= 1
+            if srv.delivery_hosts[host] == 0:
+                del srv.delivery_hosts[host]
+
+            if status >= 200 and status < 300:
+                srv.delivery_stats["completed"] += 1
+            else:
+                srv.delivery_stats["failed"] += 1
+
+            # the host answered, even if it didn't like it
+            _host_result(srv, host, status < 500)
+
+
+def _delivery_start(srv):
+    """ starts another worker, if allowed (with the delivery lock held) """
+
+    if len(srv.delivery_pending) and srv.delivery_workers < srv.config["delivery_threads"]:
+        srv.delivery_workers += 1
+        threading.Thread(target=_delivery_worker, args=(srv,), daemon=True).start()
+
+
+def deliver_later(snac, qid, q_elem):
+    """ hands an output queue item to the delivery pool (it stays in the queue until sent) """
+
+    srv = snac._server
+
+    dest, host = _delivery_dest(q_elem)
+
+    with srv.delivery_cond:
+        if (snac.basedir, qid) in srv.delivery_taken:
+            return
+
+        srv.delivery_taken.add((snac.basedir, qid))
+        srv.delivery_pending.setdefault(host, []).append((snac, qid, q_elem))
+
+        _delivery_start(srv)
+
+
+def delivery_taken(snac):
+    """ returns the ids of the queue items of a user already in the delivery pool """
+
+    srv = snac._server
+
+    with srv.delivery_cond:
+        return set(qid for b, qid in srv.delivery_taken if b == snac.basedir)
+
+
+def delivery_wait(srv):
+    """ waits until all pending items are delivered """
+
+    with srv.delivery_cond:
+        while srv.delivery_workers:
+            srv.delivery_cond.wait()
+
+
+def delivery_stats(srv):
+    """ returns the delivery pool statistics """
+
+    with srv.delivery_cond:
+        d = dict(srv.delivery_stats)
+        d["queued"]  = sum(len(items) for items in srv.delivery_pending.values())
+        d["workers"] = srv.delivery_workers
+        d["open"]    = len([h for h in srv.host_health.values() if h["until"]])
+
+    return d
+
+
 def queue(snac):
     """ processes the output queue """
 
-    for q_elem in snac.data.queue(snac):
+    for qid, q_elem in snac.data.queue_due(snac, delivery_taken(snac)):
 
         if q_elem["type"] != "output":
             snac.debug(1, "ignored q_elem type '%s'" % q_elem["type"])
+            snac.data.queue_done(snac, qid)
             continue
 
-        actor   = q_elem["actor"]
-        msg     = q_elem["object"]
-        retries = q_elem["retries"]
+        deliver_later(snac, qid, q_elem)
 
-        # strip snac metadata
-        try:
-            del(msg["_snac"])
-        except:
-            pass
+    srv = snac._server
 
-        # send
-        status, body = send_to_actor(snac, actor, msg)
+    # not running as a daemon? wait until everything is sent
+    if not srv.server_on:
+        delivery_wait(srv)
+    else:
+        # probe the hosts with open circuits, if it's time
+        with srv.delivery_cond:
+            _delivery_start(srv)
 
-        if status < 200 or status >= 300:
-            # failed; too much tries?
-            if retries > snac.server["queue_retry_max"]:
-                snac.log("giving up for %s %s" % (actor, status))
-            else:
-                snac.log("requeueing for %s %s" % (actor, status))
 
-                # reenqueue
-                snac.data.enqueue_output(snac, actor, msg, retries + 1)
+def _post_shared(snac, msg, followers):
+    """ enqueues a message once per shared inbox, returning the followers not reached """
+
+    shared = {}
+    rest   = []
+
+    for fo in followers:
+        if fo["sharedInbox"] is not None:
+            shared.setdefault(fo["sharedInbox"], []).append(fo)
+        else:
+            rest.append(fo)
+
+    saved = 0
+
+    for inbox, fos in shared.items():
+        if len(fos) > 1:
+            snac.data.enqueue_output(snac, fos[0]["actor"], msg, inbox=inbox, shared=True)
+            saved += len(fos) - 1
+        else:
+            rest += fos
+
+    if saved:
+        srv = snac._server
+
+        with srv.delivery_cond:
+            srv.delivery_stats["saved"] += saved
+
+        snac.debug(1, "shared inboxes saved %d requests" % saved)
+
+    return rest
 
 
 def post_to_followers(snac, msg):
     """ post a message to all followers """
 
-    for fo in snac.data.followers(snac):
-        snac.data.enqueue_output(snac, fo["actor"], msg)
+    for fo in _post_shared(snac, msg, snac.data.follower_roster(snac)):
+        snac.data.enqueue_output(snac, fo["actor"], msg, inbox=fo["inbox"])
 
 
 def msg_rcpts(snac, msg, expand_public=False):
@@ -103,7 +432,7 @@ def msg_rcpts(snac, msg, expand_public=False):
             for r in lor:
                 # public? add all followers
                 if expand_public and r == public_address:
-                    for fo in snac.data.followers(snac):
+                    for fo in snac.data.follower_roster(snac):
                         rcpts.add(fo["actor"])
                 else:
                     rcpts.add(r)
@@ -123,8 +452,31 @@ def is_msg_public(snac, msg):
 def post(snac, msg):
     """ enqueue a message to all recipients """
 
-    for r in msg_rcpts(snac, msg, True):
-        snac.data.enqueue_output(snac, r, msg)
+    rcpts  = msg_rcpts(snac, msg, False)
+    roster = snac.data.follower_roster(snac)
+
+    # the inboxes of the followers are already known
+    inboxes = {}
+
+    for fo in roster:
+        inboxes[fo["actor"]] = fo["inbox"]
+
+    if public_address in rcpts:
+        rcpts.discard(public_address)
+
+        # the followers are reached through their shared inboxes,
+        # but the ones explicitly addressed get it in their own
+        fos = []
+
+        for fo in roster:
+            if fo["actor"] not in rcpts:
+                fos.append(fo)
+
+        for fo in _post_shared(snac, msg, fos):
+            rcpts.add(fo["actor"])
+
+    for r in rcpts:
+        snac.data.enqueue_output(snac, r, msg, inbox=inboxes.get(r))
 
 
 def process_mentions(snac, content):
@@ -542,12 +894,66 @@ def post_handler(snac, q_path, q_vars, acpt, p_data, headers):
         snac.debug(1, "error decoding JSON payload in %s" % q_path)
         return 400, "<h1>400 Bad Request</h1>", "text/html"
 
+    # already received, or being processed? (retried by the other side)
+    if "id" in msg and snac.data.seen_activity(snac, actor, msg["id"]):
+        snac.debug(1, "dropping duplicate %s %s" % (mtype, msg["id"]))
+        return 202, None, ctype
+
     snac.data.archive(snac, "<", "POST", actor, msg)
 
     if actor == snac.actor():
         snac.log("dropping message for me")
+        _seen_done(snac, msg, 400)
         return 400, "400 Bad Request", "text/plain"
 
+    # running as a daemon? store it and process it later
+    if snac._server.server_on:
+        item = {
+            "path":    q_path,
+            "payload": p_data,
+            "headers": dict((k.lower(), v) for k, v in headers.items())
+        }
+
+        id = snac.data.enqueue_input(snac, item)
+        process_later(snac, id, item)
+
+        snac.debug(2, "accepted post %s" % q_path)
+
+        return 202, None, ctype
+
+    try:
+        status = process_message(snac, q_path, msg, p_data, headers)
+    finally:
+        _seen_done(snac, msg, status)
+
+    if status == 400:
+        return 400, "<h1>400 Bad Request</h1>", "text/html"
+
+    snac.debug(2, "serving post %s %s" % (q_path, status))
+
+    return status, body, ctype
+
+
+def _seen_done(snac, msg, status):
+    """ remembers a processed message, so that it's not processed again, or forgets it if it failed """
+
+    try:
+        actor, id = msg["actor"], msg["id"]
+    except:
+        return
+
+    if status >= 200 and status <= 299:
+        snac.data.add_seen_activity(snac, actor, id)
+    else:
+        snac.data.forget_seen_activity(snac, actor, id)
+
+
+def process_message(snac, q_path, msg, p_data, headers):
+    """ processes a received message """
+
+    actor = msg["actor"]
+    mtype = msg["type"]
+
     # check headers
     s_status = snac.http.check_signature(snac, q_path, p_data, headers)
 
@@ -555,7 +961,7 @@ def post_handler(snac, q_path, q_vars, acpt, p_data, headers):
         if s_status != 410:
             snac.log("signature check failure from %s %s" % (actor, s_status))
 
-        return 400, "<h1>400 Bad Request</h1>", "text/html"
+        return 400
 
     status = 200
 
@@ -618,46 +1024,8 @@ def post_handler(snac, q_path, q_vars, acpt, p_data, headers):
                 except:
                     in_reply_to = None
 
-                # recursively download in_reply_tos
-                nid = in_reply_to
-                while nid is not None:
-                    irt2 = None
-
-                    s_status, s_body = snac.data.get_from_timeline(snac, nid)
-
-                    if s_status < 200 or s_status > 299:
-                        s_status, s_body = snac.data.request_object(snac, nid)
-
-                        if s_status >= 200 and s_status <= 299:
-                            # does it have an in_reply_to itself?
-                            try:
-                                irt2 = s_body["inReplyTo"]
-                            except:
-                                try:
-                                    irt2 = s_body["object"]["inReplyTo"]
-                                except:
-                                    pass
-
-                            snac.data.add_to_timeline(snac, s_body, nid, irt2)
-
-                        snac.debug(2, "requested in_reply_to %s %s" % (nid, s_status))
-
-                    else:
-                        snac.debug(2, "in_reply_to already here %s" % nid)
-
-                        # this is ugly af
-                        try:
-                            irt2 = s_body["inReplyTo"]
-                        except:
-                            try:
-                                irt2 = s_body["object"]["inReplyTo"]
-                            except:
-                                pass
-
-                    nid = irt2
-
-                # store the message itself
-                snac.data.add_to_timeline(snac, msg, msg["object"]["id"], in_reply_to)
+                # store the message itself (the in_reply_tos come later)
+                add_reply(snac, msg, msg["object"]["id"], in_reply_to)
                 snac.log("new note %s" % actor)
 
         else:
@@ -750,7 +1118,305 @@ def post_handler(snac, q_path, q_vars, acpt, p_data, headers):
     else:
         snac.debug(1, "message type '%s' ignored" % mtype)
 
-    if status != 0:
-        snac.debug(2, "serving post %s %s" % (q_path, status))
+    return status
 
-    return status, body, ctype
+
+""" ancestors """
+
+def _in_reply_to(obj):
+    """ returns the in_reply_to of an object (or its Create), or None """
+
+    try:
+        return obj["inReplyTo"]
+    except:
+        try:
+            return obj["object"]["inReplyTo"]
+        except:
+            return None
+
+
+def _ancestor_register(snac, nid, child):
+    """ adds a child to an ancestor being fetched; returns False if it's not """
+
+    srv = snac._server
+    k   = (snac.basedir, nid)
+
+    with srv.ancestor_cond:
+        if k not in srv.ancestor_fetching:
+            return False
+
+        if child not in srv.ancestor_fetching[k]:
+            srv.ancestor_fetching[k].append(child)
+
+    return True
+
+
+def _ancestor_schedule(snac, nid, child, depth):
+    """ schedules the fetching of the first missing ancestor """
+
+    srv = snac._server
+
+    # go up the thread while they are already here
+    while nid is not None:
+        if depth > srv.config["ancestor_depth"]:
+            snac.debug(1, "in_reply_to too deep %s" % nid)
+            return
+
+        # already being fetched? it will be its child too
+        if _ancestor_register(snac, nid, child):
+            return
+
+        s_status, s_body = snac.data.get_from_timeline(snac, nid)
+
+        if s_status < 200 or s_status > 299:
+            break
+
+        snac.debug(2, "in_reply_to already here %s" % nid)
+
+        child = nid
+        nid   = _in_reply_to(s_body)
+        depth += 1
+
+    if nid is None:
+        return
+
+    k = (snac.basedir, nid)
+
+    with srv.ancestor_cond:
+        # started meanwhile?
+        if k in srv.ancestor_fetching:
+            if child not in srv.ancestor_fetching[k]:
+                srv.ancestor_fetching[k].append(child)
+
+            return
+
+        # (if it was stored meanwhile, the fetcher just links the child)
+        srv.ancestor_fetching[k] = [child]
+        srv.ancestor_pending.append((snac, nid, depth))
+
+        # start another fetcher, if allowed
+        if srv.ancestor_workers < srv.config["ancestor_threads"]:
+            srv.ancestor_workers += 1
+            threading.Thread(target=_ancestor_worker, args=(srv,), daemon=True).start()
+
+
+def _ancestor_fetch(snac, nid, depth):
+    """ fetches an ancestor and stores it, with its children """
+
+    srv = snac._server
+    k   = (snac.basedir, nid)
+
+    # stored meanwhile? (by another fetcher that just finished)
+    s_status, s_body = snac.data.get_from_timeline(snac, nid)
+
+    if s_status < 200 or s_status > 299:
+        s_status, s_body = snac.data.request_object(snac, nid)
+
+    if s_status < 200 or s_status > 299:
+        with srv.ancestor_cond:
+            srv.ancestor_fetching.pop(k, None)
+            srv.ancestor_stats["failed"] += 1
+
+    else:
+        irt2 = _in_reply_to(s_body)
+
+        # its own in_reply_to
+        if irt2 is not None:
+            _ancestor_schedule(snac, irt2, nid, depth + 1)
+
+        with srv.ancestor_cond:
+            children = list(srv.ancestor_fetching[k])
+
+        # stored with its children; the ones registered meanwhile
+        # (that may have not seen it stored) are added afterwards
+        while True:
+            snac.data.add_to_timeline(snac, s_body, nid, irt2, children)
+
+            with srv.ancestor_cond:
+                l = srv.ancestor_fetching[k]
+
+                if len(l) == len(children):
+                    del srv.ancestor_fetching[k]
+                    srv.ancestor_stats["fetched"] += 1
+                    break
+
+                children = list(l)
+
+    snac.debug(2, "requested in_reply_to %s %s" % (nid, s_status))
+
+
+def _ancestor_worker(srv):
+    """ fetcher thread: fetches the pending ancestors, one at a time by host """
+
+    while True:
+        with srv.ancestor_cond:
+            e = None
+
+            for i, (snac, nid, depth) in enumerate(srv.ancestor_pending):
+                host = urllib.parse.urlparse(nid).netloc
+
+                if host not in srv.ancestor_hosts:
+                    e = srv.ancestor_pending[i]
+                    del srv.ancestor_pending[i]
+                    break
+
+            if e is None:
+                srv.ancestor_workers -= 1
+                return
+
+            srv.ancestor_hosts.add(host)
+
+        snac, nid, depth = e
+
+        try:
+            _ancestor_fetch(snac, nid, depth)
+        except:
+            snac.log("error fetching in_reply_to %s" % nid)
+
+            with srv.ancestor_cond:
+                srv.ancestor_fetching.pop((snac.basedir, nid), None)
+
+        with srv.ancestor_cond:
+            srv.ancestor_hosts.discard(host)
+
+
+def add_reply(snac, msg, id, in_reply_to):
+    """ stores a message and fetches its ancestors in the background """
+
+    # registered as a child before being stored: if the parent is stored
+    # first, it's with this message among its children; if not, this
+    # message is linked to it when stored
+    if in_reply_to is not None:
+        _ancestor_schedule(snac, in_reply_to, id, 1)
+
+    snac.data.add_to_timeline(snac, msg, id, in_reply_to)
+
+
+def ancestor_stats(srv):
+    """ returns the ancestor fetcher statistics """
+
+    with srv.ancestor_cond:
+        d = dict(srv.ancestor_stats)
+        d["queued"]    = len(srv.ancestor_pending)
+        d["in_flight"] = len(srv.ancestor_hosts)
+
+    return d
+
+
+""" input pool """
+
+def _input_worker(srv):
+    """ input thread: processes the received messages """
+
+    while True:
+        with srv.input_cond:
+            e = None
+
+            for i, (snac, id, item) in enumerate(srv.input_pending):
+                # keep the order of the messages from each actor
+                if item["actor"] not in srv.input_actors:
+                    e = srv.input_pending[i]
+                    del srv.input_pending[i]
+                    break
+
+            if e is None:
+                srv.input_workers -= 1
+                srv.input_cond.notify_all()
+                return
+
+            snac, id, item = e
+
+            srv.input_actors.add(item["actor"])
+            srv.input_stats["in_flight"] += 1
+
+        msg = None
+
+        try:
+            msg    = json.loads(item["payload"])
+            status = process_message(snac, item["path"], msg, item["payload"], item["headers"])
+        except:
+            snac.log("error processing input %s" % id)
+            status = 500
+
+        _seen_done(snac, msg, status)
+
+        # done (even if it failed; it won't be better next time)
+        snac.data.input_done(snac, id)
+
+        with srv.input_cond:
+            srv.input_actors.discard(item["actor"])
+            srv.input_taken.discard((snac.basedir, id))
+            srv.input_stats["in_flight"] -= 1
+
+            if status >= 200 and status < 300:
+                srv.input_stats["processed"] += 1
+            else:
+                srv.input_stats["failed"] += 1
+
+
+def process_later(snac, id, item):
+    """ hands a received message to the input pool """
+
+    srv = snac._server
+
+    # the actor, to keep the order
+    try:
+        item["actor"] = json.loads(item["payload"])["actor"]
+    except:
+        item["actor"] = None
+
+    with srv.input_cond:
+        # already there? (e.g. when recovering)
+        if (snac.basedir, id) in srv.input_taken:
+            return
+
+    # taken in the storage too, so that it's only processed once
+    if not snac.data.input_take(snac, id):
+        return
+
+    with srv.input_cond:
+        srv.input_taken.add((snac.basedir, id))
+        srv.input_pending.append((snac, id, item))
+
+        # start another worker, if allowed
+        if srv.input_workers < srv.config["input_threads"]:
+            srv.input_workers += 1
+            threading.Thread(target=_input_worker, args=(srv,), daemon=True).start()
+
+
+def input_recover(snac):
+    """ hands the messages received but not processed (e.g. before a restart) to the input pool """
+
+    srv = snac._server
+    n   = 0
+
+    for id, item in snac.data.input_items(snac):
+        with srv.input_cond:
+            if (snac.basedir, id) in srv.input_taken:
+                continue
+
+        # taken as being processed, as when received
+        try:
+            msg = json.loads(item["payload"])
+            snac.data.seen_activity(snac, msg["actor"], msg["id"])
+        except:
+            pass
+
+        process_later(snac, id, item)
+        n += 1
+
+    if n:
+        snac.log("recovered %d received messages" % n)
+
+    return n
+
+
+def input_stats(srv):
+    """ returns the input pool statistics """
+
+    with srv.input_cond:
+        d = dict(srv.input_stats)
+        d["queued"]  = len(srv.input_pending)
+        d["workers"] = srv.input_workers
+
+    return d
@@ -9,6 +9,16 @@ import glob
 import re
 import hashlib
 import random
+import threading
+import contextlib
+import fcntl
+import bisect
+import zlib
+import gzip
+import collections
+import shutil
+import urllib.parse
+import heapq
 
 # data layout version
 layout_version = 1
@@ -40,6 +50,44 @@ def check_password(uid, passwd, hash):
     n_hash = hash_password(uid, passwd, nonce)
     return bool(hash == n_hash)
 
+# separators for compact JSON
+compact = (",", ":")
+
+def encode(snac, obj, compress=False):
+    """ encodes an object to be stored, as set in the encoding config """
+
+    enc = snac.server["encoding"]
+
+    if enc == "json":
+        data = json.dumps(obj, indent=4).encode()
+    else:
+        data = json.dumps(obj, separators=compact).encode()
+
+    # only timeline and actor files are compressed
+    if compress:
+        if enc == "zlib":
+            data = zlib.compress(data)
+        elif enc == "gzip":
+            data = gzip.compress(data, mtime=0)
+
+    return data
+
+def decompress(data):
+    """ returns the JSON of a stored object, decompressed if needed """
+
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    elif data[:1] == b"\x78":
+        data = zlib.decompress(data)
+
+    return data
+
+
+def decode(data):
+    """ decodes a stored object, whatever its encoding """
+
+    return json.loads(decompress(data))
+
 def save_cfgfile(fn, content, error="OK"):
     """ saves a config file """
 
@@ -118,6 +166,18 @@ def open_server(srv):
     if config["layout"] < layout_version:
         return False, "unsupported old layout v.%d -- try upgrade tool" % config["layout"]
 
+    # the actor cache, shared by all users
+    try:
+        os.makedirs("%s/actors" % srv.basedir, exist_ok=True)
+    except:
+        pass
+
+    # choose the storage implementation
+    if config["storage"] == "sqlite":
+        srv.data = SNAC.data_sqlite
+    elif config["storage"] not in ("files", "segments"):
+        return False, "unsupported storage '%s'" % config["storage"]
+
     return True, error
 
 
@@ -207,15 +267,10 @@ def request_object(snac, url):
     else:
         source = "remote"
 
-        t = time.time()
-
-        # do an HTTP request
-        status, body = snac.http.request_signed(snac, "GET", url)
-
-        snac.debug(2, "request_signed %f seconds %s" % (time.time() - t, url))
+        # already parsed
+        status, body = _request_remote_object(snac, url)
 
-
-    if status >= 200 and status <= 299:
+    if status >= 200 and status <= 299 and source != "remote":
         try:
             body = json.loads(body)
 
@@ -228,508 +283,2450 @@ def request_object(snac, url):
     return status, body
 
 
-def add_to_followers(snac, actor, msg):
-    """ adds a follower """
+""" membership sets """
 
-    fn = "%s/followers/%s.json" % (snac.basedir, md5(actor))
+# the MD5s in the followers, following and muted directories,
+# by directory, as [time of last check, directory mtime, set]
+_members      = {}
+_members_lock = threading.Lock()
 
-    with open(fn, "w") as f:
-        f.write(json.dumps(msg, indent=4))
-        snac.debug(2, "saved into followers %s %s" % (actor, fn))
+def _members_get(snac, dir):
+    """ returns the set of MD5s in a user directory """
 
-    return 201 # created
+    d = "%s/%s" % (snac.basedir, dir)
+    t = time.time()
 
+    with _members_lock:
+        m = _members.get(d)
 
-def delete_from_followers(snac, actor, msg):
-    """ deletes a follower """
+        # external changes are looked for once a second
+        if m is not None and m[0] + 1 > t:
+            return m[2]
 
-    fn = "%s/followers/%s.json" % (snac.basedir, md5(actor))
+        try:
+            mtime = os.stat(d).st_mtime_ns
+        except:
+            mtime = 0
 
-    try:
-        os.unlink(fn)
-        snac.debug(2, "deleted from followers %s %s" % (actor, fn))
-        ret = 200
+        if m is None or m[1] != mtime:
+            try:
+                l = os.listdir(d)
+            except:
+                l = []
 
-    except:
-        snac.debug(1, "I/O error deleting from followers %s %s" % (actor, fn))
-        ret = 200 # or 400 bad request?
+            m = [t, mtime, set([fn.split(".")[0] for fn in l])]
+            _members[d] = m
 
-    return ret
+            snac.debug(2, "loaded %s (%d)" % (d, len(m[2])))
 
+        else:
+            m[0] = t
 
-def is_follower(snac, actor):
-    """ returns True if someone is a follower """
+        return m[2]
 
-    fn = "%s/followers/%s.json" % (snac.basedir, md5(actor))
-    ret = True
 
-    try:
-        open(fn)
-    except:
-        ret = False
+def _members_drop(snac, dir):
+    """ invalidates the set of a user directory """
 
-    snac.debug(2, "check followers %s %s" % (actor, ret))
+    with _members_lock:
+        _members.pop("%s/%s" % (snac.basedir, dir), None)
 
-    return ret
 
+""" seen activities """
 
-def followers(snac):
-    """ iterates the followers """
+def _seen_load(srv):
+    """ loads the recently seen activities (with the seen lock held) """
 
-    for fn in glob.glob("%s/followers/*.json" % snac.basedir):
-        with open(fn, "r") as f:
-            msg = json.loads(f.read())
+    if srv.seen is not None:
+        return
 
-        yield msg
+    srv.seen       = collections.OrderedDict()
+    srv.seen_lines = 0
 
+    try:
+        with open("%s/seen.idx" % srv.basedir) as f:
+            for l in f:
+                k = l.rstrip("\n")
+
+                srv.seen[k] = True
+                srv.seen.move_to_end(k)
+                srv.seen_lines += 1
+
+    except:
+        pass
+
+    while len(srv.seen) > srv.config["seen_entries"]:
+        srv.seen.popitem(last=False)
 
-def timeline_mtime(snac):
-    """ returns the modification time of the timeline """
 
+def _seen_key(snac, actor, id):
+    """ returns the key of an activity in the seen set, or None """
+
+    # only the ids from the actor's own host: anyone could send
+    # a message with the id of another's and have it dropped
     try:
-        s = os.stat("%s/timeline" % snac.basedir)
-        mtime = s.st_mtime
+        if urllib.parse.urlparse(id).netloc != urllib.parse.urlparse(actor).netloc:
+            return None
     except:
-        mtime = 0
+        return None
 
-    return mtime
+    return "%s %s %s" % (snac.user["uid"], actor, id)
 
 
-def timeline_file_name(snac, id):
-    """ returns the timeline file name for an id """
+def seen_activity(snac, actor, id):
+    """ checks if an activity was already received by this user from this actor (if not, it's taken) """
 
-    l = glob.glob("%s/timeline/*-%s.json" % (snac.basedir, md5(id)))
+    srv = snac._server
+    k   = _seen_key(snac, actor, id)
 
-    if len(l) > 0:
-        fn = l[0]
-    else:
-        fn = None
+    if k is None:
+        return False
 
-    return fn
+    with srv.seen_lock:
+        _seen_load(srv)
 
+        if k in srv.seen:
+            srv.seen.move_to_end(k)
+            srv.seen_stats["hits"] += 1
+            return True
 
-def get_from_timeline(snac, id):
-    """ returns a message from the timeline """
+        # still being processed?
+        if k in srv.seen_taken:
+            srv.seen_stats["hits"] += 1
+            return True
 
-    fn = timeline_file_name(snac, id)
+        srv.seen_taken.add(k)
+        srv.seen_stats["misses"] += 1
 
-    if fn is not None:
-        with open(fn) as f:
-            msg = json.loads(f.read())
+    return False
 
-        status = 200
 
-    else:
-        status, msg = 404, None
+def forget_seen_activity(snac, actor, id):
+    """ forgets an activity taken as being processed (e.g. as it failed) """
 
-    return status, msg
+    srv = snac._server
+    k   = _seen_key(snac, actor, id)
 
+    with srv.seen_lock:
+        srv.seen_taken.discard(k)
 
-def delete_from_timeline(snac, id):
-    """ deletes a message from the timeline """
 
-    fn = timeline_file_name(snac, id)
+def add_seen_activity(snac, actor, id):
+    """ remembers an activity received by this user from this actor, once processed """
 
-    if fn is not None:
-        try:
-            os.unlink(fn)
-            snac.debug(1, "deleted from timeline %s" % id)
+    srv = snac._server
+    k   = _seen_key(snac, actor, id)
+    fn  = "%s/seen.idx" % srv.basedir
 
-        except:
-            snac.debug(1, "I/O error deleting from timeline %s" % id)
-            pass
+    if k is None:
+        return
+
+    with srv.seen_lock:
+        _seen_load(srv)
+
+        srv.seen_taken.discard(k)
+
+        if k in srv.seen:
+            return
+
+        srv.seen[k] = True
+
+        while len(srv.seen) > srv.config["seen_entries"]:
+            srv.seen.popitem(last=False)
 
-        # try to delete also from the local timeline
         try:
-            lfn = fn.replace("/timeline/", "/local/")
-            os.unlink(lfn)
-            snac.debug(1, "deleted from local %s" % id)
+            # too many forgotten ones in the file? rewrite it
+            if srv.seen_lines >= 2 * srv.config["seen_entries"]:
+                with open(fn + ".tmp", "w") as f:
+                    for e in srv.seen:
+                        f.write(e + "\n")
+
+                os.rename(fn + ".tmp", fn)
+                srv.seen_lines = len(srv.seen)
+
+            else:
+                with open(fn, "a") as f:
+                    f.write(k + "\n")
+
+                srv.seen_lines += 1
 
         except:
-            pass
+            srv.log("error writing %s" % fn)
 
-    return fn
 
+def seen_stats(srv):
+    """ returns the seen activities statistics """
 
-def add_to_timeline(snac, msg, id, parent=None):
-    """ adds a message to the public timeline """
+    with srv.seen_lock:
+        d = dict(srv.seen_stats)
+        d["entries"] = len(srv.seen or [])
 
-    fn = "%s/timeline/%s-%s.json" % (snac.basedir, snac.tid(), md5(id))
+    return d
 
-    try:
-        os.stat(fn)
-        snac.debug(1, "refusing to rewrite timeline %s %s" % (id, fn))
-        return
-    except:
-        pass
 
-    # add the metadata
-    msg["_snac"] = {
-        "children":     [],
-        "parent":       parent,
-        "liked_by":     [],
-        "announced_by": []
-    }
+""" remote object cache """
 
-    with open(fn, "w") as f:
-        f.write(json.dumps(msg, indent=4))
-        snac.debug(1, "added to timeline %s %s" % (id, fn))
+# the remote objects are cached in memory for all the users (in
+# srv.object_cache, as url: (time, ttl, etag, last modified, obj),
+# least recently used first) and revalidated with conditional GETs;
+# only public ones, as others were only given to the user that asked
 
-    if id.startswith(snac.actor()) or (parent and parent.startswith(snac.actor())):
-        try:
-            lfn = fn.replace("/timeline/", "/local/")
-            os.link(fn, lfn)
-            snac.debug(1, "added to local %s %s" % (id, lfn))
+_actor_types = ("Person", "Service", "Group", "Application", "Organization")
 
-        except:
-            snac.debug(1, "I/O error linking %s %s" % (fn, lfn))
+def _object_public(obj):
+    """ checks if an object (or the one it wraps) is addressed to the public """
 
-    if parent is not None:
-        # do we have the parent stored here?
-        pfn = timeline_file_name(snac, parent)
+    if obj.get("type") in _actor_types:
+        return True
 
-        if pfn is not None:
-            with open(pfn) as f:
-                p_msg = json.loads(f.read())
+    for o in (obj, obj.get("object")):
+        if not isinstance(o, dict):
+            continue
 
-            if msg["type"] == "Like":
-                if p_msg["_snac"].get("liked_by") is None:
-                    p_msg["_snac"]["liked_by"] = []
+        for k in ("to", "cc"):
+            l = o.get(k) or []
 
-                p_msg["_snac"]["liked_by"].append(msg["actor"]);
+            if isinstance(l, str):
+                l = [l]
 
-            if msg["type"] == "Announce":
-                if p_msg["_snac"].get("announced_by") is None:
-                    p_msg["_snac"]["announced_by"] = []
+            for r in l:
+                if r in ("https://www.w3.org/ns/activitystreams#Public", "as:Public", "Public"):
+                    return True
 
-                p_msg["_snac"]["announced_by"].append(msg["actor"]);
+    return False
 
-            # append this message to the children list
-            p_msg["_snac"]["children"].append(id)
 
-            # now rename all tree up the timeline
-            while parent is not None:
-                # delete old file
-                try:
-                    os.unlink(pfn)
+def _object_ttl(snac, obj):
+    """ returns the seconds an object can be used without revalidation """
 
-                except:
-                    snac.debug(1, "I/O error deleting parent from timeline %s" % pfn)
+    ttls = snac.server["object_ttl_minutes"]
+    t    = obj.get("type")
 
-                # now re-insert the parent with a new timestamp
-                npfn = "%s/timeline/%s-%s.json" % (snac.basedir, snac.tid(), md5(parent))
+    # actors have their own cache; always revalidate them
+    if t in _actor_types:
+        t = "actor"
 
-                with open(npfn, "w") as f:
-                    f.write(json.dumps(p_msg, indent=4))
-                    snac.debug(1, "updated parent to timeline %s %s" % (parent, npfn))
+    return ttls.get(t, ttls["default"]) * 60
 
-                # repeat for the local timeline
-                try:
-                    olfn = pfn.replace("/timeline/", "/local/")
-                    nlfn = npfn.replace("/timeline/", "/local/")
 
-                    os.unlink(olfn)
-                    os.link(npfn, nlfn)
-                    snac.debug(1, "updated parent to local %s %s" % (parent, nlfn))
+def _request_remote_object(snac, url):
+    """ requests a remote object, using the cache; returns it already parsed """
 
-                except:
-                    pass
+    srv = snac._server
 
-                parent = p_msg["_snac"]["parent"]
+    with srv.object_lock:
+        c     = srv.object_cache.get(url)
+        fresh = c is not None and c[0] + c[1] > time.time()
 
-                if parent is not None:
-                    pfn = timeline_file_name(snac, parent)
+        if c is not None:
+            srv.object_cache.move_to_end(url)
 
-                    if pfn is not None:
-                        with open(pfn) as f:
-                            p_msg = json.loads(f.read())
+        if fresh:
+            srv.object_stats["hits"] += 1
 
-                    else:
-                        parent = None
+    if fresh:
+        return 200, _json_copy(c[4])
 
+    # ask only if modified
+    headers  = {}
+    rheaders = {}
 
-def timeline(snac):
-    """ iterates the entries in the timeline """
+    if c is not None:
+        if c[2] is not None:
+            headers["If-None-Match"] = c[2]
+        if c[3] is not None:
+            headers["If-Modified-Since"] = c[3]
 
-    # maximum entries to return
-    max = snac.server["max_timeline_entries"]
+    t = time.time()
 
-    for fn in sorted(glob.glob("%s/timeline/*.json" % snac.basedir), reverse=True)[:max]:
-        with open(fn) as f:
-            msg = json.loads(f.read())
+    # do an HTTP request
+    status, body = snac.http.request_signed(snac, "GET", url,
+        headers=headers, rheaders=rheaders)
 
-            yield msg
+    snac.debug(2, "request_signed %f seconds %s %s" % (time.time() - t, url, status))
 
+    if status == 304 and c is not None:
+        # not modified
+        with srv.object_lock:
+            srv.object_stats["revalidated"] += 1
 
-def purge_timeline(snac):
-    """ deletes old entries from the timeline """
+        status, obj = 200, c[4]
 
-    snac.debug(2, "purging timeline for %s" % snac.user["uid"])
+    elif status >= 200 and status <= 299:
+        with srv.object_lock:
+            srv.object_stats["misses"] += 1
 
-    mt = time.time() - (snac.server["timeline_purge_days"] * 24 * 3600)
+        try:
+            obj = json.loads(body)
 
-    for fn in glob.glob("%s/timeline/*.json" % snac.basedir):
-        # get the basename
-        bn = fn.split("/")[-1]
-        tt = float(bn.split("-")[0])
+        except:
+            snac.log("cannot parse JSON for object %s" % url)
+            return 404, None
 
-        if tt < mt:
-            try:
-                os.unlink(fn)
-                snac.debug(1, "purged from timeline %s" % fn)
-            except:
-                snac.log("error purging from timeline %s" % fn)
+    else:
+        return status, body
 
+    if isinstance(obj, dict) and _object_public(obj):
+        with srv.object_lock:
+            srv.object_cache[url] = (time.time(), _object_ttl(snac, obj),
+                rheaders.get("etag", c and c[2]), rheaders.get("last-modified", c and c[3]), obj)
+            srv.object_cache.move_to_end(url)
 
-def add_to_following(snac, actor, msg):
-    """ adds someone to the following list """
+            while len(srv.object_cache) > srv.config["object_cache_entries"]:
+                srv.object_cache.popitem(last=False)
 
-    fn = "%s/following/%s.json" % (snac.basedir, md5(actor))
+    return status, _json_copy(obj)
 
-    with open(fn, "w") as f:
-        f.write(json.dumps(msg, indent=4))
-        snac.debug(2, "added to following %s %s" % (actor, fn))
 
-    return 201 # created
+def object_cache_stats(srv):
+    """ returns the counters of the remote object cache """
 
+    with srv.object_lock:
+        d = dict(srv.object_stats)
 
-def following(snac, actor):
-    """ returns someone we're following or None """
+        d["entries"] = len(srv.object_cache)
 
-    fn = "%s/following/%s.json" % (snac.basedir, md5(actor))
+    return d
 
-    try:
-        with open(fn) as f:
-            obj    = json.loads(f.read())
-            status = 200
 
-    except:
-        status, obj = 404, None
+def add_to_followers(snac, actor, msg):
+    """ adds a follower """
 
-    snac.debug(3, "get from following %s %s" % (actor, status))
+    fn = "%s/followers/%s.json" % (snac.basedir, md5(actor))
 
-    return status, obj
+    with open(fn, "wb") as f:
+        f.write(encode(snac, msg))
+        snac.debug(2, "saved into followers %s %s" % (actor, fn))
 
+    _members_drop(snac, "followers")
 
-def delete_from_following(snac, actor):
-    """ deletes from following """
+    # the inboxes, from the cached actor
+    obj = cached_actor(snac, actor)
+
+    if obj is None and not snac._server.server_on:
+        # no daemon (i.e. from the command line); request it now
+        status, obj = snac.data.request_actor(snac, actor)
+
+        if status != 200:
+            obj = None
+
+    _roster_set(snac, actor, roster_entry(actor, obj))
+
+    # not there? it's requested in the background, and the roster updated then
+    if obj is None and snac._server.server_on:
+        actor_refresh_later(snac, actor, True)
+
+    return 201 # created
 
-    fn = "%s/following/%s.json" % (snac.basedir, md5(actor))
+
+def delete_from_followers(snac, actor, msg):
+    """ deletes a follower """
+
+    fn = "%s/followers/%s.json" % (snac.basedir, md5(actor))
 
     try:
         os.unlink(fn)
-        snac.debug(2, "deleted from following %s %s" % (actor, fn))
+        snac.debug(2, "deleted from followers %s %s" % (actor, fn))
         ret = 200
 
     except:
-        snac.debug(1, "I/O error deleting from following %s %s" % (actor, fn))
+        snac.debug(1, "I/O error deleting from followers %s %s" % (actor, fn))
         ret = 200 # or 400 bad request?
 
-    return ret
+    _members_drop(snac, "followers")
+    _roster_set(snac, actor, None)
 
+    return ret
 
-def mute(snac, actor):
-    """ mutes an actor """
 
-    fn = "%s/muted/%s" % (snac.basedir, md5(actor))
+def is_follower(snac, actor):
+    """ returns True if someone is a follower """
 
-    with open(fn, "w") as f:
-        f.write(actor)
-        snac.debug(2, "added to muted %s %s" % (actor, fn))
+    ret = md5(actor) in _members_get(snac, "followers")
 
-    return 201 # created
+    snac.debug(2, "check followers %s %s" % (actor, ret))
 
+    return ret
 
-def unmute(snac, actor):
-    """ unmutes an actor """
 
-    fn = "%s/muted/%s" % (snac.basedir, md5(actor))
+def followers(snac):
+    """ iterates the followers """
 
-    try:
-        os.unlink(fn)
-        snac.debug(2, "deleted from muted %s %s" % (actor, fn))
-    except:
-        snac.debug(1, "I/O error trying to delete from muted %s %s" % (actor, fn))
+    for fn in glob.glob("%s/followers/*.json" % snac.basedir):
+        with open(fn, "rb") as f:
+            msg = decode(f.read())
 
-    return 200 # created
+        yield msg
 
 
-def is_muted(snac, actor):
-    """ returns True if an actor is muted """
+""" follower roster """
 
-    fn = "%s/muted/%s" % (snac.basedir, md5(actor))
+# loaded rosters, by file name, as (mtime, MD5s of the actors, list)
+_rosters     = {}
+_roster_lock = threading.RLock()
 
-    try:
-        open(fn)
-        ret = True
-    except:
-        ret = False
+def roster_entry(actor, obj=None):
+    """ returns the roster entry of a follower, with the inboxes from its actor object """
 
-    snac.debug(2, "check muted %s %s" % (actor, ret))
+    e = {
+        "actor":       actor,
+        "inbox":       None,
+        "sharedInbox": None,
+        "host":        urllib.parse.urlparse(actor).netloc
+    }
 
-    return ret
+    if obj is not None:
+        e["inbox"] = obj.get("inbox")
 
+        try:
+            e["sharedInbox"] = obj["endpoints"]["sharedInbox"]
+        except:
+            pass
 
-def add_to_actors(snac, actor, msg):
-    """ stores an actor """
+    return e
 
-    fn = "%s/actors/%s.json" % (snac.basedir, md5(actor))
 
-    with open(fn, "w") as f:
-        f.write(json.dumps(msg, indent=4))
-        snac.debug(2, "added to actors %s %s" % (actor, fn))
+def _roster_write(snac, l):
+    """ writes the roster and keeps it loaded """
 
+    fn = "%s/followers.idx" % snac.basedir
 
-def request_actor(snac, actor):
-    """ requests an actor using the cache """
+    with open(fn + ".tmp", "w") as f:
+        for e in l:
+            f.write("%s\n" % " ".join([e[k] or "-" for k in ("actor", "inbox", "sharedInbox", "host")]))
 
-    fn = "%s/actors/%s.json" % (snac.basedir, md5(actor))
+    os.rename(fn + ".tmp", fn)
 
-    try:
-        s = os.stat(fn)
-        mtime = s.st_mtime
-    except:
-        mtime = 0
+    _rosters[fn] = (os.stat(fn).st_mtime_ns, set([md5(e["actor"]) for e in l]), l)
 
-    # seconds to consider a cached entry to be rotten
-    max_time = 3600 * 36
 
-    if mtime + max_time < time.time():
-        # stale or new? request it
-        snac.debug(2, "actor cache miss for %s %s" % (actor, fn))
+def follower_roster(snac):
+    """ returns the followers as a list of actor, inbox, sharedInbox and host dicts """
 
-        status, body = snac.data.request_object(snac, actor)
+    # the returned list is shared; it must not be modified
 
-        if status >= 200 and status <= 299:
-            add_to_actors(snac, actor, body)
+    fn = "%s/followers.idx" % snac.basedir
 
-        else:
-            if mtime:
-                # touch the file to change its mtime by adding an
-                # innocuous blank at the end, so we don't hammer the site
-                with open(fn, "a") as f:
-                    f.write(" ")
+    with _roster_lock:
+        r = _rosters.get(fn)
 
-                snac.debug(1, "serving stale actor %s %s" % (actor, status))
-            else:
-                snac.debug(1, "cannot retrieve actor %s %s" % (actor, status))
+        try:
+            mtime = os.stat(fn).st_mtime_ns
+        except:
+            mtime = 0
 
-    else:
-        # still valid
-        snac.debug(2, "actor cache hit for %s %s" % (actor, fn))
+        if mtime != 0 and (r is None or r[0] != mtime):
+            l = []
 
-    if mtime != 0:
-        with open(fn, "r") as f:
-            body = json.loads(f.read())
+            with open(fn) as f:
+                for line in f:
+                    v = [None if x == "-" else x for x in line.split()]
 
-        status = 200
+                    if len(v) == 4:
+                        l.append(dict(zip(("actor", "inbox", "sharedInbox", "host"), v)))
 
-    return status, body
+            r = (mtime, set([md5(e["actor"]) for e in l]), l)
+            _rosters[fn] = r
 
+        # in sync with the followers directory? (it may be changed
+        # externally, or the roster not created yet)
+        fs = _members_get(snac, "followers")
 
-def enqueue_output(snac, actor, msg, retries=0):
-    """ enqueue a message to be sent """
+        if r is None or r[1] != fs:
+            l = [e for e in (r[2] if r else []) if md5(e["actor"]) in fs]
+            n = fs - set([md5(e["actor"]) for e in l])
 
-    if actor == snac.actor():
-        snac.debug(1, "refusing to enqueue a message to ourselves")
-        return
+            for fo in followers(snac):
+                if md5(fo["actor"]) in n:
+                    l.append(roster_entry(fo["actor"], cached_actor(snac, fo["actor"])))
 
-    fn = "%s/queue/%s.json" % (snac.basedir,
-        snac.tid(retries * 60 * snac.server["queue_retry_minutes"]))
+            _roster_write(snac, l)
+            r = _rosters[fn]
 
-    with open(fn + ".tmp", "w") as f:
-        r = {
-            "type":    "output",
-            "actor":   actor,
-            "object":  msg,
-            "retries": retries
-        }
+            snac.debug(1, "rebuilt follower roster (%d)" % len(l))
 
-        f.write(json.dumps(r, indent=4))
+        return r[2]
 
-    try:
-        os.rename(fn + ".tmp", fn)
-        snac.debug(2, "enqueue message for %s %s %d" % (actor, fn, retries))
-    except:
-        snac.log("I/O error enqueueing message for %s %s" % (actor, fn))
 
+def roster_refresh(snac, actor):
+    """ updates the roster entry of a follower from its cached actor """
 
-def queue(snac):
-    """ iterates the queue """
+    if md5(actor) in _members_get(snac, "followers"):
+        _roster_set(snac, actor, roster_entry(actor, cached_actor(snac, actor)))
 
-    dir = "%s/queue" % snac.basedir
-    t   = time.time()
 
-    for fn in glob.glob(dir + "/*.json"):
-        # get the basename
-        bn = fn[0:-5].split("/")[-1]
+def _roster_set(snac, actor, e):
+    """ sets (or deletes, if e is None) the roster entry of an actor """
 
-        if float(bn) > t:
-            snac.debug(2, "queue not yet time for %s" % fn)
-        else:
-            with open(fn, "r") as f:
-                m = json.loads(f.read())
+    with _roster_lock:
+        l = [x for x in follower_roster(snac) if x["actor"] != actor]
 
-            # dequeue
-            os.unlink(fn)
+        if e is not None:
+            l.append(e)
 
-            snac.debug(2, "dequeued %s" % fn)
+        _roster_write(snac, l)
 
-            yield m
 
+def timeline_mtime(snac):
+    """ returns the modification time of the timeline """
 
-def local_mtime(snac):
-    """ returns the modification time of the local timeline """
+    mtime = 0
 
-    try:
-        s = os.stat("%s/local" % snac.basedir)
-        mtime = s.st_mtime
-    except:
-        mtime = 0
+    # the index is also written on every timeline change
+    for fn in ("%s/timeline" % snac.basedir, _tl_index_fn(snac)):
+        try:
+            s = os.stat(fn)
+            mtime = max(mtime, s.st_mtime)
+        except:
+            pass
 
     return mtime
 
 
-def locals(snac):
-    """ iterates the entries in local """
+def _tl_bucket(snac, tid):
+    """ returns the bucket (subdirectory) for a tid, or None if not bucketed """
 
-    # maximum entries to return
-    max = 256
+    b = snac.server["timeline_buckets"]
 
-    for fn in sorted(glob.glob("%s/local/*.json" % snac.basedir), reverse=True):
-        max -= 1
+    if b == "day":
+        return time.strftime("%Y-%m-%d", time.gmtime(float(tid)))
+    elif b == "month":
+        return time.strftime("%Y-%m", time.gmtime(float(tid)))
 
-        if max == 0:
-            break
+    return None
 
-        with open(fn) as f:
-            msg = json.loads(f.read())
 
-            yield msg
+def _tl_bucket_expired(b, mt):
+    """ returns True if a bucket only holds entries older than mt """
 
+    # compare with the bucket of mt, of the same size
+    if len(b) == 7:
+        return b < time.strftime("%Y-%m", time.gmtime(mt))
+    else:
+        return b < time.strftime("%Y-%m-%d", time.gmtime(mt))
 
-def static(snac, url):
-    """ serves an static file """
 
-    id = url.split("/")[-1]
-    fn = "%s/static/%s" % (snac.basedir, id)
+def timeline_files(snac, dir="timeline"):
+    """ returns the (file name, location) of the entries in timeline/ or local/ """
 
-    try:
-        with open(fn) as f:
-            body   = f.read()
-            status = 200
-    except:
-        status, body = 404, None
+    l = []
 
-    snac.debug(2, "get static %s %s" % (fn, status))
+    # flat and bucketed
+    for fn in glob.glob("%s/%s/*.json" % (snac.basedir, dir)) + \
+              glob.glob("%s/%s/*/*.json" % (snac.basedir, dir)):
+        l.append((fn, fn[len(snac.basedir) + len(dir) + 2:]))
 
-    return status, body
+    # sorted by name (i.e. by creation time)
+    return sorted(l, key=lambda x: x[1].split("/")[-1])
 
 
-def purge(snac):
-    """ purges all purgeable things """
+""" timeline index """
+
+# in-memory copies of the timeline indexes, by index file name
+_tl_indexes = {}
+_tl_index_lock = threading.RLock()
+
+# held segment locks, by user base directory
+_tl_flocks = {}
+
+# size from which a new timeline segment is started
+segment_max_size = 8 * 1024 * 1024
+
+def _tl_segmented(snac):
+    """ returns True if the timeline is stored in segments """
+
+    return snac.server["storage"] == "segments"
+
+
+def _tl_index_fn(snac):
+    """ returns the file name of the timeline index """
+
+    if _tl_segmented(snac):
+        return "%s/segments/index" % snac.basedir
+    else:
+        return "%s/timeline.idx" % snac.basedir
+
+
+def _tl_index_line(md, e):
+    """ formats a timeline index line (e is None for deletions) """
+
+    if e is None:
+        return "%s -\n" % md
+    else:
+        return "%s %s %s %d %s\n" % (md, e[0], e[1], e[2], e[3])
+
+
+@contextlib.contextmanager
+def timeline_lock(snac):
+    """ locks the timeline against other threads and processes """
+
+    with _tl_index_lock:
+        # already held by this thread?
+        if snac.basedir in _tl_flocks:
+            yield
+            return
+
+        # the index is rewritten (e.g. by purge, from cron) while
+        # the daemon appends to it, so other processes are locked out too
+        if _tl_segmented(snac):
+            os.makedirs("%s/segments" % snac.basedir, exist_ok=True)
+            lfn = "%s/segments/lock" % snac.basedir
+        else:
+            lfn = "%s/timeline.lock" % snac.basedir
+
+        with open(lfn, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _tl_flocks[snac.basedir] = f
+
+            try:
+                yield
+
+            finally:
+                del(_tl_flocks[snac.basedir])
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _tl_index_write(snac, entries):
+    """ writes a full timeline index """
+
+    fn = _tl_index_fn(snac)
+
+    with open(fn + ".tmp", "w") as f:
+        for md, e in entries.items():
+            f.write(_tl_index_line(md, e))
+
+    os.rename(fn + ".tmp", fn)
+
+    # force a reload on next access
+    _tl_indexes.pop(fn, None)
+
+
+def timeline_index_rebuild(snac):
+    """ rebuilds the timeline index from the stored entries """
+
+    with timeline_lock(snac):
+        if _tl_segmented(snac):
+            entries = _seg_scan(snac)
+
+        else:
+            entries = {}
+
+            # the local entries purged from the timeline are also indexed;
+            # sorted, so the newest file wins if an id is duplicated
+            for d in ("local", "timeline"):
+                for tfn, loc in timeline_files(snac, d):
+                    tid, md = loc.split("/")[-1][:-5].split("-")
+                    local = d == "local" or os.path.exists("%s/local/%s" % (snac.basedir, loc))
+
+                    # the last activity is lost; the best guess is the mtime,
+                    # as the files are rewritten when they get new children
+                    tid = "%17.6f" % max(float(tid), os.stat(tfn).st_mtime)
+
+                    # the parent is unknown until needed
+                    entries[md] = (tid, loc, local, "?")
+
+        _tl_index_write(snac, entries)
+
+        snac.debug(1, "rebuilt timeline index %s (%d entries)" % (
+            _tl_index_fn(snac), len(entries)))
+
+    return len(entries)
+
+
+def _tl_index_set(idx, md, e):
+    """ sets an entry into a loaded index, keeping the ordered lists """
+
+    old = idx["entries"].pop(md, None)
+
+    if idx["order"] is not None:
+        for l, o, n in ((idx["order"], old, e), (idx["local"], old and old[2], e and e[2])):
+            if o:
+                i = bisect.bisect_left(l, (old[0], md))
+
+                if i < len(l) and l[i] == (old[0], md):
+                    del(l[i])
+
+            if n:
+                bisect.insort(l, (e[0], md))
+
+    if e is not None:
+        idx["entries"][md] = e
+
+
+def _tl_index_load(snac):
+    """ returns the loaded timeline index, up to date with the disk """
+
+    fn = _tl_index_fn(snac)
+
+    with timeline_lock(snac):
+        idx = _tl_indexes.get(fn)
+
+        try:
+            s = os.stat(fn)
+        except:
+            # no index yet? create it
+            timeline_index_rebuild(snac)
+            idx = None
+            s   = os.stat(fn)
+
+        if idx is not None and idx["ino"] == s.st_ino and idx["offset"] == s.st_size:
+            # nothing new
+            return idx
+
+        with open(fn, "rb") as f:
+            s = os.fstat(f.fileno())
+
+            # replaced (rebuilt) or truncated? start from scratch
+            if idx is None or idx["ino"] != s.st_ino or idx["offset"] > s.st_size:
+                # the ordered lists of (tid, md5) are built after loading
+                idx = {
+                    "ino":      s.st_ino,
+                    "offset":   0,
+                    "entries":  {},
+                    "order":    None,
+                    "local":    None
+                }
+
+                _tl_indexes[fn] = idx
+
+            f.seek(idx["offset"])
+            data = f.read()
+
+        # only process complete lines
+        data = data[:data.rfind(b"\n") + 1]
+        idx["offset"] += len(data)
+
+        for l in data.decode().splitlines():
+            f = l.split(" ")
+
+            if len(f) == 2 and f[1] == "-":
+                _tl_index_set(idx, f[0], None)
+            elif len(f) == 5:
+                _tl_index_set(idx, f[0], (f[1], f[2], f[3] == "1", f[4]))
+            elif len(f) == 4:
+                # old format: no parent
+                _tl_index_set(idx, f[0], (f[1], f[2], f[3] == "1", "?"))
+            else:
+                snac.log("bad line in timeline index '%s'" % l)
+
+        if idx["order"] is None:
+            entries = idx["entries"]
+
+            idx["order"] = sorted([(e[0], md) for md, e in entries.items()])
+            idx["local"] = [x for x in idx["order"] if entries[x[1]][2]]
+
+        return idx
+
+
+def timeline_index(snac):
+    """ returns the timeline index (md5 of id -> (tid, location, local, parent md5)) """
+
+    return _tl_index_load(snac)["entries"]
+
+
+def timeline_index_page(snac, local=False, before=None, limit=256):
+    """ returns a page of timeline index entries, newest first """
+
+    with timeline_lock(snac):
+        idx = _tl_index_load(snac)
+
+        if local:
+            l = idx["local"]
+        else:
+            l = idx["order"]
+
+        if before is None:
+            i = len(l)
+        else:
+            i = bisect.bisect_left(l, (before,))
+
+        return [idx["entries"][md] for tid, md in reversed(l[max(0, i - limit):i])]
+
+
+def timeline_index_update(snac, md, e):
+    """ sets the timeline index entry for an id md5 (None to delete it) """
+
+    with timeline_lock(snac):
+        # ensure the index exists before appending to it
+        timeline_index(snac)
+
+        with open(_tl_index_fn(snac), "a") as f:
+            f.write(_tl_index_line(md, e))
+
+
+def timeline_file_name(snac, id):
+    """ returns the timeline file name for an id """
+
+    e = timeline_index(snac).get(md5(id))
+
+    if e is None:
+        fn = None
+    elif _tl_segmented(snac):
+        fn = _seg_fn(snac, int(e[1].split(":")[0]))
+    else:
+        fn = "%s/timeline/%s" % (snac.basedir, e[1])
+
+    return fn
+
+
+""" timeline segments """
+
+def _seg_fn(snac, n):
+    """ returns the file name of a segment """
+
+    return "%s/segments/%08d.seg" % (snac.basedir, n)
+
+
+def _seg_list(snac):
+    """ returns the sorted list of segment numbers """
+
+    l = []
+
+    for fn in glob.glob("%s/segments/*.seg" % snac.basedir):
+        l.append(int(fn.split("/")[-1][:-4]))
+
+    return sorted(l)
+
+
+def _seg_append(snac, rec):
+    """ appends a record to the last segment and returns its location """
+
+    data = (json.dumps(rec, separators=compact) + "\n").encode()
+
+    l = _seg_list(snac)
+
+    if len(l):
+        n = l[-1]
+
+        # too big? start a new one
+        if os.stat(_seg_fn(snac, n)).st_size >= segment_max_size:
+            n += 1
+    else:
+        n = 0
+
+    with open(_seg_fn(snac, n), "ab") as f:
+        offset = f.tell()
+        f.write(data)
+
+    return "%d:%d:%d" % (n, offset, len(data))
+
+
+def _seg_read_raw(snac, locs):
+    """ returns the records at many locations as a dict, in disk order """
+
+    recs  = {}
+    files = {}
+
+    try:
+        for loc in sorted(locs, key=lambda x: [int(y) for y in x.split(":")]):
+            n, offset, size = [int(x) for x in loc.split(":")]
+
+            try:
+                f = files.get(n)
+
+                if f is None:
+                    f = open(_seg_fn(snac, n), "rb")
+                    files[n] = f
+
+                f.seek(offset)
+                recs[loc] = f.read(size)
+
+            except:
+                snac.debug(1, "cannot read from segment %s" % loc)
+
+    finally:
+        for f in files.values():
+            f.close()
+
+    return recs
+
+
+def _seg_read_many(snac, es):
+    """ returns the (entry, message) pairs of many index entries, in order """
+
+    l = [(e, _tl_cache_get(snac, e[1], None)) for e in es]
+
+    # read the ones not in the cache at once
+    recs = _seg_read_raw(snac, [e[1] for e, msg in l if msg is None])
+
+    for i, (e, msg) in enumerate(l):
+        data = recs.get(e[1])
+
+        if data is not None:
+            msg = json.loads(data)["msg"]
+            _tl_cache_put(snac, e[1], None, len(data), msg)
+
+            l[i] = (e, msg)
+
+    return [(e, msg) for e, msg in l if msg is not None]
+
+
+def _seg_scan(snac):
+    """ builds a timeline index by scanning the segments """
+
+    entries = {}
+
+    l = _seg_list(snac)
+
+    if len(l) == 0:
+        # first time: import the timeline files (and the
+        # local ones already purged from it), if any
+        done = set()
+
+        for tfn, loc in timeline_files(snac) + timeline_files(snac, "local"):
+            bn    = loc.split("/")[-1]
+            local = os.path.exists("%s/local/%s" % (snac.basedir, loc))
+
+            if bn in done:
+                continue
+
+            try:
+                with open(tfn, "rb") as f:
+                    msg = decode(f.read())
+
+                _seg_append(snac, {
+                    "md5":   bn[:-5].split("-")[1],
+                    "tid":   bn.split("-")[0],
+                    "local": local,
+                    "msg":   msg
+                })
+
+                done.add(bn)
+
+            except:
+                snac.log("cannot import into segments %s" % tfn)
+
+        l = _seg_list(snac)
+
+    for n in l:
+        offset = 0
+
+        with open(_seg_fn(snac, n), "rb") as f:
+            for data in f:
+                try:
+                    rec = json.loads(data)
+                    md  = rec["md5"]
+
+                    if rec.get("deleted"):
+                        entries.pop(md, None)
+
+                    elif rec.get("bump"):
+                        # only a new position in the timeline
+                        if md in entries:
+                            entries[md] = (rec["tid"],) + entries[md][1:]
+
+                    else:
+                        parent = rec["msg"]["_snac"]["parent"]
+
+                        entries[md] = (rec["tid"],
+                            "%d:%d:%d" % (n, offset, len(data)), rec["local"],
+                            md5(parent) if parent is not None else "-")
+
+                except:
+                    snac.log("bad record in segment %d offset %d" % (n, offset))
+
+                offset += len(data)
+
+    return entries
+
+
+def timeline_compact(snac, purge_before=None):
+    """ compacts the timeline segments, optionally purging old entries """
+
+    if not _tl_segmented(snac):
+        return
+
+    with timeline_lock(snac):
+        idx = timeline_index(snac)
+        l   = _seg_list(snac)
+
+        if purge_before is None:
+            # not worth it until dead records use as much as the live ones
+            size = sum([os.stat(_seg_fn(snac, n)).st_size for n in l])
+            live = sum([int(e[1].split(":")[2]) for e in idx.values()])
+
+            if size - live < max(live, segment_max_size):
+                return
+
+        recs    = _seg_read_raw(snac, [e[1] for e in idx.values()])
+        entries = {}
+        purged  = 0
+        n       = l[-1] if len(l) else 0
+        f       = None
+
+        # rewrite the live records, oldest first, after the current segments
+        for md, e in sorted(idx.items(), key=lambda x: x[1]):
+            data = recs.get(e[1])
+
+            if data is None:
+                continue
+
+            # local entries are never purged
+            if purge_before is not None and not e[2] and float(e[0]) < purge_before:
+                purged += 1
+                continue
+
+            # store the bumps into the record itself
+            rec = json.loads(data)
+            rec["tid"] = e[0]
+
+            data = (json.dumps(rec, separators=compact) + "\n").encode()
+
+            if f is None or f.tell() >= segment_max_size:
+                if f is not None:
+                    f.close()
+
+                n += 1
+                f = open(_seg_fn(snac, n), "wb")
+
+            entries[md] = (e[0], "%d:%d:%d" % (n, f.tell(), len(data)), e[2], e[3])
+            f.write(data)
+
+        if f is not None:
+            f.close()
+
+        _tl_index_write(snac, entries)
+
+        for n in l:
+            os.unlink(_seg_fn(snac, n))
+
+        # all the locations changed
+        _tl_cache_drop(snac)
+
+        snac.debug(1, "compacted timeline segments (%d entries, %d purged)" % (
+            len(entries), purged))
+
+
+""" timeline message cache """
+
+# parsed timeline messages, by user directory and location, as
+# (stamp, size, msg), least recently used first; the stamp is the
+# file identity (segment locations never change their content)
+_tl_cache       = collections.OrderedDict()
+_tl_cache_lock  = threading.Lock()
+_tl_cache_stats = { "hits": 0, "misses": 0, "entries": 0, "bytes": 0 }
+
+def _json_copy(o):
+    """ copies a parsed JSON object (much faster than copy.deepcopy) """
+
+    if isinstance(o, dict):
+        return {k: _json_copy(v) for k, v in o.items()}
+
+    if isinstance(o, list):
+        return [_json_copy(v) for v in o]
+
+    return o
+
+
+def _tl_cache_get(snac, loc, stamp):
+    """ returns a copy of a cached message, or None """
+
+    with _tl_cache_lock:
+        k = (snac.basedir, loc)
+        c = _tl_cache.get(k)
+
+        if c is None or c[0] != stamp:
+            _tl_cache_stats["misses"] += 1
+            return None
+
+        _tl_cache.move_to_end(k)
+        _tl_cache_stats["hits"] += 1
+
+        msg = c[2]
+
+    # copy, so the callers can do whatever they want with it
+    return _json_copy(msg)
+
+
+def _tl_cache_put(snac, loc, stamp, size, msg):
+    """ stores a copy of a message into the cache """
+
+    budget = snac.server["timeline_cache_mb"] * 1024 * 1024
+
+    if size > budget:
+        return
+
+    msg = _json_copy(msg)
+
+    with _tl_cache_lock:
+        k = (snac.basedir, loc)
+        c = _tl_cache.pop(k, None)
+
+        if c is not None:
+            _tl_cache_stats["bytes"] -= c[1]
+
+        _tl_cache[k] = (stamp, size, msg)
+        _tl_cache_stats["bytes"] += size
+
+        # evict the least recently used ones
+        while _tl_cache_stats["bytes"] > budget:
+            k, c = _tl_cache.popitem(last=False)
+            _tl_cache_stats["bytes"] -= c[1]
+
+        _tl_cache_stats["entries"] = len(_tl_cache)
+
+
+def _tl_cache_drop(snac, loc=None):
+    """ drops a location (or all locations of the user) from the cache """
+
+    with _tl_cache_lock:
+        if loc is not None:
+            ks = [(snac.basedir, loc)]
+        else:
+            ks = [k for k in _tl_cache.keys() if k[0] == snac.basedir]
+
+        for k in ks:
+            c = _tl_cache.pop(k, None)
+
+            if c is not None:
+                _tl_cache_stats["bytes"] -= c[1]
+
+        _tl_cache_stats["entries"] = len(_tl_cache)
+
+
+def timeline_cache_stats():
+    """ returns the counters of the timeline message cache """
+
+    with _tl_cache_lock:
+        return dict(_tl_cache_stats)
+
+
+""" timeline """
+
+def _tl_read(snac, e):
+    """ reads the message of a timeline index entry """
+
+    if _tl_segmented(snac):
+        return _seg_read_many(snac, [e])[0][1]
+
+    try:
+        f = open("%s/timeline/%s" % (snac.basedir, e[1]), "rb")
+    except:
+        # local entries purged from the timeline are still here
+        if not e[2]:
+            raise
+
+        f = open("%s/local/%s" % (snac.basedir, e[1]), "rb")
+
+    with f:
+        st    = os.fstat(f.fileno())
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        msg = _tl_cache_get(snac, e[1], stamp)
+
+        if msg is None:
+            # the budget is for the JSON, not the (maybe compressed) file
+            data = decompress(f.read())
+            msg  = json.loads(data)
+            _tl_cache_put(snac, e[1], stamp, len(data), msg)
+
+        return msg
+
+
+def _tl_read_many(snac, es):
+    """ iterates the messages of many index entries, in order """
+
+    # the position is stored in the metadata, to be used as a cursor
+
+    if _tl_segmented(snac):
+        for e, msg in _seg_read_many(snac, es):
+            msg["_snac"]["tid"] = e[0]
+            yield msg
+
+        return
+
+    for e in es:
+        try:
+            msg = _tl_read(snac, e)
+        except:
+            snac.debug(1, "cannot read timeline entry %s" % e[1])
+            continue
+
+        msg["_snac"]["tid"] = e[0]
+        yield msg
+
+
+def _tl_get(snac, id):
+    """ returns the index entry and the message for an id """
+
+    e = timeline_index(snac).get(md5(id))
+
+    if e is not None:
+        try:
+            return e, _tl_read(snac, e)
+
+        except:
+            snac.debug(1, "cannot read timeline entry %s %s" % (id, e[1]))
+
+    return None, None
+
+
+def _tl_write(snac, id, msg, local, old=None):
+    """ stores a timeline entry (replacing old) with a new tid and indexes it """
+
+    tid    = snac.tid()
+    parent = msg["_snac"]["parent"]
+
+    if _tl_segmented(snac):
+        loc = _seg_append(snac, {
+            "md5":   md5(id),
+            "tid":   tid,
+            "local": local,
+            "msg":   msg
+        })
+
+        if old is not None:
+            _tl_cache_drop(snac, old[1])
+
+    else:
+        # the file name keeps the original tid
+        if old is not None:
+            loc = old[1]
+        else:
+            loc = "%s-%s.json" % (tid, md5(id))
+
+            # new entries go to the current bucket, if any
+            b = _tl_bucket(snac, tid)
+
+            if b is not None:
+                loc = "%s/%s" % (b, loc)
+
+                for d in ("timeline", "local"):
+                    os.makedirs("%s/%s/%s" % (snac.basedir, d, b), exist_ok=True)
+
+        fn = "%s/timeline/%s" % (snac.basedir, loc)
+
+        with open(fn + ".tmp", "wb") as f:
+            f.write(encode(snac, msg, True))
+
+        os.rename(fn + ".tmp", fn)
+        _tl_cache_drop(snac, loc)
+
+        if local:
+            try:
+                lfn = fn.replace("/timeline/", "/local/")
+
+                if old is not None:
+                    os.unlink(lfn)
+
+                os.link(fn, lfn)
+                snac.debug(1, "added to local %s %s" % (id, lfn))
+
+            except:
+                snac.debug(1, "I/O error linking %s %s" % (fn, lfn))
+
+    e = (tid, loc, local, md5(parent) if parent is not None else "-")
+
+    timeline_index_update(snac, md5(id), e)
+
+    return e
+
+
+def _tl_bump(snac, md, e):
+    """ moves a timeline entry to the top, only touching the index """
+
+    tid = snac.tid()
+
+    if _tl_segmented(snac):
+        # keep it also in the segments, to survive index rebuilds
+        _seg_append(snac, { "md5": md, "tid": tid, "bump": True })
+
+    e = (tid,) + e[1:]
+
+    timeline_index_update(snac, md, e)
+
+    return e
+
+
+def _tl_unlink(snac, id, e):
+    """ deletes the files of a timeline entry (not segmented) """
+
+    fn = "%s/timeline/%s" % (snac.basedir, e[1])
+
+    _tl_cache_drop(snac, e[1])
+
+    try:
+        os.unlink(fn)
+        snac.debug(1, "deleted from timeline %s" % id)
+
+    except:
+        snac.debug(1, "I/O error deleting from timeline %s" % id)
+
+    # try to delete also from the local timeline
+    try:
+        lfn = fn.replace("/timeline/", "/local/")
+        os.unlink(lfn)
+        snac.debug(1, "deleted from local %s" % id)
+
+    except:
+        pass
+
+
+def get_from_timeline(snac, id):
+    """ returns a message from the timeline """
+
+    e, msg = _tl_get(snac, id)
+
+    if msg is not None:
+        status = 200
+    else:
+        status = 404
+
+    return status, msg
+
+
+def delete_from_timeline(snac, id):
+    """ deletes a message from the timeline """
+
+    with timeline_lock(snac):
+        fn = timeline_file_name(snac, id)
+
+        if fn is not None:
+            e = timeline_index(snac).get(md5(id))
+
+            if _tl_segmented(snac):
+                _seg_append(snac, { "md5": md5(id), "tid": e[0], "deleted": True })
+                _tl_cache_drop(snac, e[1])
+                snac.debug(1, "deleted from timeline %s" % id)
+            else:
+                _tl_unlink(snac, id, e)
+
+            timeline_index_update(snac, md5(id), None)
+
+    return fn
+
+
+def add_to_timeline(snac, msg, id, parent=None, children=None):
+    """ adds a message to the public timeline with the children already there (only them, if stored) """
+
+    with timeline_lock(snac):
+        ofn = timeline_file_name(snac, id)
+
+        if ofn is not None:
+            # already here: only the children it doesn't have are added
+            e, o_msg = _tl_get(snac, id)
+
+            if o_msg is not None:
+                new = [c for c in (children or []) if c not in o_msg["_snac"]["children"]]
+            else:
+                new = []
+
+            if len(new):
+                o_msg["_snac"]["children"] += new
+                e = _tl_write(snac, id, o_msg, e[2], e)
+                snac.debug(1, "added children to timeline %s %s" % (id, e[1]))
+            else:
+                snac.debug(1, "refusing to rewrite timeline %s %s" % (id, ofn))
+
+            return
+
+        # add the metadata
+        msg["_snac"] = {
+            "children":     list(children or []),
+            "parent":       parent,
+            "liked_by":     [],
+            "announced_by": []
+        }
+
+        local = id.startswith(snac.actor()) or (
+            parent is not None and parent.startswith(snac.actor()))
+
+        e = _tl_write(snac, id, msg, local)
+        snac.debug(1, "added to timeline %s %s" % (id, e[1]))
+
+        if parent is not None:
+            # do we have the parent stored here?
+            pe, p_msg = _tl_get(snac, parent)
+
+            if p_msg is not None:
+                if msg["type"] == "Like":
+                    if p_msg["_snac"].get("liked_by") is None:
+                        p_msg["_snac"]["liked_by"] = []
+
+                    p_msg["_snac"]["liked_by"].append(msg["actor"]);
+
+                if msg["type"] == "Announce":
+                    if p_msg["_snac"].get("announced_by") is None:
+                        p_msg["_snac"]["announced_by"] = []
+
+                    p_msg["_snac"]["announced_by"].append(msg["actor"]);
+
+                # append this message to the children list
+                # (unless it was stored with them, as a fetched ancestor)
+                if id not in p_msg["_snac"]["children"]:
+                    p_msg["_snac"]["children"].append(id)
+
+                # the parent is rewritten with a new timestamp...
+                pe = _tl_write(snac, parent, p_msg, pe[2], pe)
+                snac.debug(1, "updated parent to timeline %s %s" % (parent, pe[1]))
+
+                # ...and the rest of the tree up is only moved in the index
+                seen = set()
+                md   = pe[3]
+
+                while md != "-" and md not in seen:
+                    seen.add(md)
+
+                    ae = timeline_index(snac).get(md)
+
+                    if ae is None:
+                        break
+
+                    if ae[3] == "?":
+                        # parent not yet known: read it once
+                        try:
+                            a_parent = _tl_read(snac, ae)["_snac"]["parent"]
+                        except:
+                            a_parent = None
+
+                        ae = ae[:3] + (md5(a_parent) if a_parent is not None else "-",)
+
+                    ae = _tl_bump(snac, md, ae)
+                    snac.debug(1, "updated parent to timeline %s" % ae[1])
+
+                    md = ae[3]
+
+
+def timeline(snac, before=None, limit=None):
+    """ iterates the entries in the timeline, older than the before tid """
+
+    # maximum entries to return
+    if limit is None:
+        limit = snac.server["max_timeline_entries"]
+
+    for msg in _tl_read_many(snac, timeline_index_page(snac, False, before, limit)):
+        yield msg
+
+
+def purge_timeline(snac):
+    """ deletes old entries from the timeline """
+
+    snac.debug(2, "purging timeline for %s" % snac.user["uid"])
+
+    mt = time.time() - (snac.server["timeline_purge_days"] * 24 * 3600)
+
+    if _tl_segmented(snac):
+        timeline_compact(snac, mt)
+        return
+
+    # the index is read, rewritten and renamed into place while locked
+    # against the running server too, so no new entry is lost meanwhile
+    with timeline_lock(snac):
+        entries = {}
+        buckets = set()
+        index   = timeline_index(snac)
+
+        # buckets holding entries bumped (e.g. replied to) after mt
+        # cannot go away at once
+        alive = set()
+
+        for md, e in index.items():
+            if "/" in e[1] and float(e[0]) >= mt:
+                alive.add(e[1].split("/")[0])
+
+        for md, e in index.items():
+            b = e[1].split("/")[0] if "/" in e[1] else None
+
+            if b is not None and b not in alive and _tl_bucket_expired(b, mt):
+                # bucketed entries go away with their bucket
+                buckets.add(b)
+
+                if not e[2]:
+                    continue
+
+            elif float(e[0]) < mt:
+                fn = "%s/timeline/%s" % (snac.basedir, e[1])
+
+                try:
+                    os.unlink(fn)
+                    snac.debug(1, "purged from timeline %s" % fn)
+                except:
+                    if not e[2]:
+                        snac.log("error purging from timeline %s" % fn)
+
+                # local entries are never purged (they stay in local/)
+                if not e[2]:
+                    continue
+
+            entries[md] = e
+
+        # also compacts the index
+        _tl_index_write(snac, entries)
+
+        # delete the expired buckets at once (their local/ ones stay)
+        for fn in glob.glob("%s/timeline/*/" % snac.basedir):
+            b = fn.split("/")[-2]
+
+            if b not in alive and (b in buckets or _tl_bucket_expired(b, mt)):
+                shutil.rmtree(fn, ignore_errors=True)
+                snac.debug(1, "purged from timeline bucket %s" % b)
+
+
+def add_to_following(snac, actor, msg):
+    """ adds someone to the following list """
+
+    fn = "%s/following/%s.json" % (snac.basedir, md5(actor))
+
+    with open(fn, "wb") as f:
+        f.write(encode(snac, msg))
+        snac.debug(2, "added to following %s %s" % (actor, fn))
+
+    _members_drop(snac, "following")
+
+    return 201 # created
+
+
+def following(snac, actor):
+    """ returns someone we're following or None """
+
+    fn = "%s/following/%s.json" % (snac.basedir, md5(actor))
+
+    status, obj = 404, None
+
+    if md5(actor) in _members_get(snac, "following"):
+        try:
+            with open(fn, "rb") as f:
+                obj    = decode(f.read())
+                status = 200
+
+        except:
+            pass
+
+    snac.debug(3, "get from following %s %s" % (actor, status))
+
+    return status, obj
+
+
+def delete_from_following(snac, actor):
+    """ deletes from following """
+
+    fn = "%s/following/%s.json" % (snac.basedir, md5(actor))
+
+    try:
+        os.unlink(fn)
+        snac.debug(2, "deleted from following %s %s" % (actor, fn))
+        ret = 200
+
+    except:
+        snac.debug(1, "I/O error deleting from following %s %s" % (actor, fn))
+        ret = 200 # or 400 bad request?
+
+    _members_drop(snac, "following")
+
+    return ret
+
+
+def following_list(snac):
+    """ iterates the actors we're following """
+
+    for fn in glob.glob("%s/following/*.json" % snac.basedir):
+        try:
+            with open(fn, "rb") as f:
+                msg = decode(f.read())
+
+            # the Follow (not yet confirmed) or the Accept
+            if msg["type"] == "Accept":
+                yield msg["actor"]
+            else:
+                yield msg["object"]
+
+        except:
+            pass
+
+
+def mute(snac, actor):
+    """ mutes an actor """
+
+    fn = "%s/muted/%s" % (snac.basedir, md5(actor))
+
+    with open(fn, "w") as f:
+        f.write(actor)
+        snac.debug(2, "added to muted %s %s" % (actor, fn))
+
+    _members_drop(snac, "muted")
+
+    return 201 # created
+
+
+def unmute(snac, actor):
+    """ unmutes an actor """
+
+    fn = "%s/muted/%s" % (snac.basedir, md5(actor))
+
+    try:
+        os.unlink(fn)
+        snac.debug(2, "deleted from muted %s %s" % (actor, fn))
+    except:
+        snac.debug(1, "I/O error trying to delete from muted %s %s" % (actor, fn))
+
+    _members_drop(snac, "muted")
+
+    return 200 # created
+
+
+def is_muted(snac, actor):
+    """ returns True if an actor is muted """
+
+    ret = md5(actor) in _members_get(snac, "muted")
+
+    snac.debug(2, "check muted %s %s" % (actor, ret))
+
+    return ret
+
+
+""" actor cache """
+
+# the actors are cached for all the users of the server, in memory
+# (in srv.actor_cache, as actor: (mtime, obj), least recently used
+# first) and in BASEDIR/actors/
+
+def _actor_remember(snac, actor, c):
+    """ stores a (mtime, obj) actor cache entry into memory """
+
+    srv = snac._server
+
+    with srv.actor_lock:
+        srv.actor_cache[actor] = c
+        srv.actor_cache.move_to_end(actor)
+
+        while len(srv.actor_cache) > srv.config["actor_cache_entries"]:
+            srv.actor_cache.popitem(last=False)
+
+
+def _actor_load(snac, actor):
+    """ returns the (mtime, obj) of a cached actor, or (0, None) """
+
+    srv = snac._server
+
+    with srv.actor_lock:
+        c = srv.actor_cache.get(actor)
+
+        if c is not None:
+            srv.actor_cache.move_to_end(actor)
+            return c
+
+    fn = "%s/actors/%s.json" % (srv.basedir, md5(actor))
+
+    try:
+        if not os.path.exists(fn):
+            # not there yet; import the old copy of this user, if any
+            shutil.copy2("%s/actors/%s.json" % (snac.basedir, md5(actor)), fn)
+
+        with open(fn, "rb") as f:
+            c = (os.fstat(f.fileno()).st_mtime, decode(f.read()))
+
+    except:
+        return 0, None
+
+    _actor_remember(snac, actor, c)
+
+    return c
+
+
+def add_to_actors(snac, actor, msg):
+    """ stores an actor """
+
+    fn  = "%s/actors/%s.json" % (snac._server.basedir, md5(actor))
+    tfn = "%s.%d-%d.tmp" % (fn, os.getpid(), threading.get_ident())
+
+    with open(tfn, "wb") as f:
+        f.write(encode(snac, msg, True))
+
+    os.rename(tfn, fn)
+
+    _actor_remember(snac, actor, (time.time(), _json_copy(msg)))
+
+    # its public key could have changed
+    snac.http.key_forget(snac, actor, msg)
+
+    snac.debug(2, "added to actors %s %s" % (actor, fn))
+
+
+def cached_actor(snac, actor):
+    """ returns an actor from the cache (no network), or None """
+
+    mtime, obj = _actor_load(snac, actor)
+
+    if obj is not None:
+        obj = _json_copy(obj)
+
+    return obj
+
+
+def _actor_count(srv, k):
+    """ increments an actor cache counter """
+
+    with srv.actor_lock:
+        srv.actor_stats[k] += 1
+
+
+def _actor_negative(snac, actor):
+    """ returns the status of a recent failed request of an actor, or None """
+
+    srv = snac._server
+
+    with srv.actor_lock:
+        n = srv.actor_negative.get(actor)
+
+        if n is None:
+            return None
+
+        if n[0] < time.time():
+            del(srv.actor_negative[actor])
+            return None
+
+        srv.actor_stats["negative"] += 1
+
+        return n[1]
+
+
+def _actor_negative_set(snac, actor, status):
+    """ remembers a failed request of an actor for a while """
+
+    srv = snac._server
+
+    # Gone, not found (or any other client error), server error or unreachable
+    if status == 410:
+        k = "410"
+    elif status == 599:
+        k = "timeout"
+    elif status >= 500:
+        k = "5xx"
+    else:
+        k = "404"
+
+    t = time.time()
+
+    with srv.actor_lock:
+        srv.actor_negative[actor] = (t + srv.config["actor_negative_minutes"][k] * 60, status)
+
+        # too many? forget the expired ones
+        if len(srv.actor_negative) > srv.config["actor_cache_entries"]:
+            for a in [a for a, n in srv.actor_negative.items() if n[0] < t]:
+                del(srv.actor_negative[a])
+
+
+def _actor_refresh(snac, actor, mtime, obj):
+    """ requests an actor, storing it; returns the new (status, mtime, obj) """
+
+    srv = snac._server
+
+    status, body = snac.data.request_object(snac, actor)
+
+    if status >= 200 and status <= 299:
+        snac.data.add_to_actors(snac, actor, body)
+        mtime, obj = time.time(), body
+
+        _actor_count(srv, "refreshes")
+
+    else:
+        _actor_count(srv, "failures")
+
+        # don't hammer the site
+        _actor_negative_set(snac, actor, status)
+
+        if mtime:
+            snac.debug(1, "serving stale actor %s %s" % (actor, status))
+        else:
+            snac.debug(1, "cannot retrieve actor %s %s" % (actor, status))
+
+    return status, mtime, obj
+
+
+def _actor_refresher(snac):
+    """ refresher thread: refreshes the actors in the queue """
+
+    srv = snac._server
+
+    while True:
+        with srv.actor_lock:
+            if len(srv.actor_refresh_queue) == 0:
+                srv.actor_refreshers -= 1
+                return
+
+            q_snac, actor = srv.actor_refresh_queue.popleft()
+
+        try:
+            mtime, obj = _actor_load(q_snac, actor)
+            _actor_refresh(q_snac, actor, mtime, obj)
+
+        except:
+            q_snac.log("error refreshing actor %s" % actor)
+
+        with srv.actor_lock:
+            waiting = srv.actor_refreshing.pop(actor, [])
+
+        # new followers
+        for w_snac in waiting:
+            try:
+                w_snac.data.roster_refresh(w_snac, actor)
+            except:
+                w_snac.log("error updating the follower roster %s" % actor)
+
+
+def actor_refresh_later(snac, actor, roster=False):
+    """ queues an actor to be refreshed in the background (and then the user's follower roster) """
+
+    srv   = snac._server
+    start = False
+
+    with srv.actor_lock:
+        if actor in srv.actor_refreshing:
+            if roster:
+                srv.actor_refreshing[actor].append(snac)
+
+            return
+
+        srv.actor_refreshing[actor] = [snac] if roster else []
+        srv.actor_refresh_queue.append((snac, actor))
+
+        # start another refresher, if allowed
+        if srv.actor_refreshers < srv.config["actor_refresh_threads"]:
+            srv.actor_refreshers += 1
+            start = True
+
+    if start:
+        threading.Thread(target=_actor_refresher, args=(snac,), daemon=True).start()
+
+
+def request_actor(snac, actor):
+    """ requests an actor using the cache """
+
+    srv = snac._server
+
+    mtime, obj = _actor_load(snac, actor)
+
+    # seconds to consider a cached entry to be rotten
+    max_time = srv.config["actor_ttl_hours"] * 3600
+
+    if mtime == 0:
+        # failed not long ago?
+        status = _actor_negative(snac, actor)
+
+        if status is not None:
+            snac.debug(2, "actor negative cache hit for %s %s" % (actor, status))
+            return status, None
+
+        # new? request it
+        snac.debug(2, "actor cache miss for %s" % actor)
+        _actor_count(srv, "misses")
+
+        status, mtime, obj = _actor_refresh(snac, actor, mtime, obj)
+
+        if mtime == 0:
+            return status, None
+
+    elif mtime + max_time < time.time():
+        _actor_count(srv, "stale")
+
+        if _actor_negative(snac, actor) is not None:
+            # failed not long ago; serve it stale
+            pass
+
+        elif srv.server_on:
+            # serve it stale, but refresh it in the background
+            snac.debug(2, "actor cache stale for %s" % actor)
+            actor_refresh_later(snac, actor)
+
+        else:
+            # no daemon (i.e. from the command line); request it now
+            status, mtime, obj = _actor_refresh(snac, actor, mtime, obj)
+
+    else:
+        # still valid
+        snac.debug(2, "actor cache hit for %s" % actor)
+        _actor_count(srv, "hits")
+
+    # a copy, so the callers can do whatever they want with it
+    return 200, _json_copy(obj)
+
+
+def actor_refresh_proactive(snac):
+    """ refreshes in the background the usual actors that are about to expire """
+
+    srv = snac._server
+
+    # followers, followed and recent correspondents
+    actors = set([fo["actor"] for fo in snac.data.follower_roster(snac)])
+    actors.update(snac.data.following_list(snac))
+
+    for msg in snac.data.timeline(snac, limit=64):
+        if "actor" in msg:
+            actors.add(msg["actor"])
+
+    # refresh them in the last tenth of their life
+    t = time.time() - srv.config["actor_ttl_hours"] * 3600 * 0.9
+    n = 0
+
+    for actor in actors:
+        with srv.actor_lock:
+            c = srv.actor_cache.get(actor)
+
+        if c is not None:
+            mtime = c[0]
+        else:
+            try:
+                mtime = os.stat("%s/actors/%s.json" % (srv.basedir, md5(actor))).st_mtime
+            except:
+                continue
+
+        if mtime < t and _actor_negative(snac, actor) is None:
+            actor_refresh_later(snac, actor)
+            n += 1
+
+    if n:
+        snac.debug(1, "proactively refreshing %d actors" % n)
+
+    return n
+
+
+def actor_cache_stats(srv):
+    """ returns the counters of the actor cache """
+
+    with srv.actor_lock:
+        d = dict(srv.actor_stats)
+
+        d["entries"]  = len(srv.actor_cache)
+        d["failing"]  = len(srv.actor_negative)
+        d["queued"]  = len(srv.actor_refresh_queue)
+
+    return d
+
+
+""" queue """
+
+# the items of each user queue, as a heap of (due time, file name),
+# by queue directory, with the directory mtime when it was loaded
+# and the set of file names already deleted but still in the heap
+_queues     = {}
+_queue_lock = threading.Lock()
+
+def _queue_mtime(snac):
+    """ returns the mtime of the queue directory """
+
+    try:
+        return os.stat("%s/queue" % snac.basedir).st_mtime_ns
+    except:
+        return 0
+
+
+def _queue_heap(snac):
+    """ returns the queue heap and its deleted files, loaded again if the directory changed """
+
+    d     = "%s/queue" % snac.basedir
+    mtime = _queue_mtime(snac)
+    q     = _queues.get(d)
+
+    if q is None or q[0] != mtime:
+        h = []
+
+        for fn in glob.glob(d + "/*.json"):
+            try:
+                h.append((float(fn.split("/")[-1][:-5]), fn))
+            except:
+                pass
+
+        heapq.heapify(h)
+
+        q = [mtime, h, set()]
+        _queues[d] = q
+
+    # drop the deleted ones from the top
+    h, gone = q[1], q[2]
+
+    while len(h) and h[0][1] in gone:
+        gone.discard(heapq.heappop(h)[1])
+
+    return h, gone
+
+
+def _queue_changed(snac, mtime):
+    """ takes note of a change made by us to the queue directory """
+
+    q = _queues.get("%s/queue" % snac.basedir)
+
+    # if nobody else touched it, the heap is still good
+    if q is not None and q[0] == mtime:
+        q[0] = _queue_mtime(snac)
+
+
+def queue_wakeup(snac):
+    """ wakes up the delivery of the queues """
+
+    srv = snac._server
+
+    with srv.queue_cond:
+        srv.queue_seq += 1
+        srv.queue_cond.notify_all()
+
+
+def queue_next_due(snac, skip=()):
+    """ returns the time the next item of the queue (not in skip) is due, or None """
+
+    with _queue_lock:
+        h, gone = _queue_heap(snac)
+
+        for due, fn in heapq.nsmallest(len(skip) + len(gone) + 1, h):
+            if fn not in gone and fn.split("/")[-1][:-5] not in skip:
+                return due
+
+    return None
+
+
+def queue_retry_delay(snac, retries):
+    """ returns the seconds to wait before a retry """
+
+    if retries == 0:
+        return 0
+
+    minutes = snac.server["queue_retry_minutes"]
+    backoff = snac.server["queue_retry_backoff"]
+
+    # exponential, or linear as in the old times
+    if backoff > 1:
+        minutes *= backoff ** (retries - 1)
+    else:
+        minutes *= retries
+
+    minutes = min(minutes, snac.server["queue_retry_max_hours"] * 60)
+
+    # spread them, so a host that comes back is not hit by all at once
+    jitter = snac.server["queue_retry_jitter"]
+
+    return 60 * minutes * random.uniform(1 - jitter, 1 + jitter)
+
+
+def enqueue_output(snac, actor, msg, retries=0, inbox=None, shared=False, queued=None):
+    """ enqueue a message to be sent (to inbox, if already known; shared, if it's a shared inbox) """
+
+    if actor == snac.actor():
+        snac.debug(1, "refusing to enqueue a message to ourselves")
+        return
+
+    tid = snac.tid(queue_retry_delay(snac, retries))
+    fn  = "%s/queue/%s.json" % (snac.basedir, tid)
+
+    r = {
+        "type":    "output",
+        "actor":   actor,
+        "object":  msg,
+        "retries": retries,
+        "queued":  queued or time.time()
+    }
+
+    if inbox is not None:
+        r["inbox"] = inbox
+
+    if shared:
+        r["shared"] = True
+
+    with _queue_lock:
+        h, gone = _queue_heap(snac)
+        mtime   = _queue_mtime(snac)
+
+        with open(fn + ".tmp", "wb") as f:
+            f.write(encode(snac, r))
+
+        try:
+            os.rename(fn + ".tmp", fn)
+            heapq.heappush(h, (float(tid), fn))
+            snac.debug(2, "enqueue message for %s %s %d" % (actor, fn, retries))
+        except:
+            snac.log("I/O error enqueueing message for %s %s" % (actor, fn))
+
+        _queue_changed(snac, mtime)
+
+    queue_wakeup(snac)
+
+
+def queue_due(snac, skip=()):
+    """ iterates the items of the queue already due (not in skip), in order, as (qid, item) """
+
+    t = time.time()
+
+    with _queue_lock:
+        h, gone = _queue_heap(snac)
+
+        due = sorted(e for e in h if e[0] <= t and e[1] not in gone)
+
+    for d, fn in due:
+        qid = fn.split("/")[-1][:-5]
+
+        if qid in skip:
+            continue
+
+        try:
+            with open(fn, "rb") as f:
+                m = decode(f.read())
+
+        except FileNotFoundError:
+            # already sent by someone else
+            queue_done(snac, qid)
+            continue
+
+        except (OSError, ValueError, zlib.error):
+            # out of the way, or it would be due forever
+            dfn = dead_letter_file_name(snac)
+            snac.log("bad queue item %s, moved to %s" % (fn, dfn))
+
+            with _queue_lock:
+                h, gone = _queue_heap(snac)
+                mtime   = _queue_mtime(snac)
+
+                try:
+                    os.rename(fn, dfn)
+                except OSError:
+                    pass
+
+                gone.add(fn)
+                _queue_changed(snac, mtime)
+
+            continue
+
+        yield qid, m
+
+
+def queue_done(snac, qid):
+    """ deletes an item from the queue, once sent """
+
+    fn = "%s/queue/%s.json" % (snac.basedir, qid)
+
+    with _queue_lock:
+        h, gone = _queue_heap(snac)
+        mtime   = _queue_mtime(snac)
+
+        try:
+            os.unlink(fn)
+        except:
+            pass
+
+        gone.add(fn)
+        _queue_changed(snac, mtime)
+
+    snac.debug(2, "dequeued %s" % fn)
+
+
+def queue_postpone(snac, qid, due):
+    """ makes an item of the queue due later """
+
+    fn = "%s/queue/%s.json" % (snac.basedir, qid)
+
+    with _queue_lock:
+        h, gone = _queue_heap(snac)
+        mtime   = _queue_mtime(snac)
+
+        # the due time is the file name
+        nfn = "%s/queue/%17.6f.json" % (snac.basedir, due)
+
+        while os.path.exists(nfn):
+            due += 0.000001
+            nfn = "%s/queue/%17.6f.json" % (snac.basedir, due)
+
+        try:
+            os.rename(fn, nfn)
+            gone.add(fn)
+            heapq.heappush(h, (due, nfn))
+        except:
+            pass
+
+        _queue_changed(snac, mtime)
+
+
+def queue_items(snac):
+    """ iterates the queue without dequeuing, as (due time, item) """
+
+    for fn in glob.glob("%s/queue/*.json" % snac.basedir):
+        try:
+            with open(fn, "rb") as f:
+                yield float(fn.split("/")[-1][:-5]), decode(f.read())
+        except:
+            # already sent
+            pass
+
+
+def dead_letter_file_name(snac):
+    """ returns the file name of a new dead letter """
+
+    d = "%s/dead" % snac.basedir
+    os.makedirs(d, exist_ok=True)
+
+    return "%s/%s.json" % (d, snac.tid())
+
+
+def add_to_dead_letters(snac, q_elem, status):
+    """ keeps a queue item that could not be delivered """
+
+    fn = dead_letter_file_name(snac)
+
+    with open(fn + ".tmp", "wb") as f:
+        f.write(encode(snac, dict(q_elem, status=status)))
+
+    os.rename(fn + ".tmp", fn)
+
+    snac.debug(1, "dead letter for %s %s" % (q_elem["actor"], fn))
+
+
+def dead_letters(snac):
+    """ iterates the dead letters, as (failure time, item) """
+
+    for fn in sorted(glob.glob("%s/dead/*.json" % snac.basedir)):
+        try:
+            with open(fn, "rb") as f:
+                yield float(fn.split("/")[-1][:-5]), decode(f.read())
+        except:
+            pass
+
+
+def purge_dead_letters(snac):
+    """ deletes old dead letters """
+
+    mt = time.time() - snac.server["dead_letter_days"] * 24 * 3600
+
+    for fn in glob.glob("%s/dead/*.json" % snac.basedir):
+        if float(fn.split("/")[-1][:-5]) < mt:
+            os.unlink(fn)
+            snac.debug(1, "purged dead letter %s" % fn)
+
+
+""" input queue """
+
+def enqueue_input(snac, item):
+    """ stores a received message to be processed; returns its id """
+
+    d = "%s/input" % snac.basedir
+    os.makedirs(d, exist_ok=True)
+
+    # the thread, as many can arrive at the same time
+    id = "%s-%d" % (snac.tid(), threading.get_ident())
+    fn = "%s/%s.json" % (d, id)
+
+    with open(fn + ".tmp", "wb") as f:
+        f.write(encode(snac, item))
+
+    os.rename(fn + ".tmp", fn)
+
+    snac.debug(2, "enqueued input %s" % fn)
+
+    return id
+
+
+def input_items(snac):
+    """ iterates the received messages not yet processed, as (id, item) (on startup) """
+
+    # the ones taken before a restart are not taken any more
+    for fn in glob.glob("%s/input/*.taken" % snac.basedir):
+        try:
+            os.rename(fn, fn[:-6] + ".json")
+        except OSError:
+            pass
+
+    for fn in sorted(glob.glob("%s/input/*.json" % snac.basedir)):
+        try:
+            with open(fn, "rb") as f:
+                yield fn.split("/")[-1][:-5], decode(f.read())
+        except (OSError, ValueError, zlib.error):
+            pass
+
+
+def input_take(snac, id):
+    """ takes a received message to be processed; returns False if already taken or processed """
+
+    fn = "%s/input/%s" % (snac.basedir, id)
+
+    # only one can rename it
+    try:
+        os.rename(fn + ".json", fn + ".taken")
+        return True
+    except OSError:
+        return False
+
+
+def input_done(snac, id):
+    """ deletes a received message already processed """
+
+    try:
+        os.unlink("%s/input/%s.taken" % (snac.basedir, id))
+    except:
+        pass
+
+
+def local_mtime(snac):
+    """ returns the modification time of the local timeline """
+
+    if _tl_segmented(snac):
+        return timeline_mtime(snac)
+
+    mtime = 0
+
+    # the buckets also change
+    for fn in ["%s/local" % snac.basedir] + glob.glob("%s/local/*/" % snac.basedir):
+        try:
+            s = os.stat(fn)
+            mtime = max(mtime, s.st_mtime)
+        except:
+            pass
+
+    return mtime
+
+
+def locals(snac, before=None, limit=None):
+    """ iterates the entries in local, older than the before tid """
+
+    # maximum entries to return
+    if limit is None:
+        limit = snac.server["max_timeline_entries"]
+
+    for msg in _tl_read_many(snac, timeline_index_page(snac, True, before, limit)):
+        yield msg
+
+
+def static(snac, url):
+    """ serves an static file """
+
+    id = url.split("/")[-1]
+    fn = "%s/static/%s" % (snac.basedir, id)
+
+    try:
+        with open(fn) as f:
+            body   = f.read()
+            status = 200
+    except:
+        status, body = 404, None
+
+    snac.debug(2, "get static %s %s" % (fn, status))
+
+    return status, body
+
+
+def purge(snac):
+    """ purges all purgeable things """
 
     purge_timeline(snac)
+    snac.data.purge_dead_letters(snac)
+
+
+def _convert_file(snac, fn, compress):
+    """ rewrites a file in the configured encoding; returns True if changed """
+
+    with open(fn, "rb") as f:
+        old = f.read()
+
+    data = encode(snac, decode(old), compress)
+
+    if data == old:
+        return False
+
+    # keep the times (the actor cache depends on them)
+    st = os.stat(fn)
+
+    with open(fn + ".tmp", "wb") as f:
+        f.write(data)
+
+    os.utime(fn + ".tmp", (st.st_atime, st.st_mtime))
+    os.rename(fn + ".tmp", fn)
+
+    return True
+
+
+def _tl_rebucket(snac):
+    """ moves the timeline files to the configured buckets; returns the count """
+
+    n = 0
+
+    entries = dict(timeline_index(snac))
+
+    for md, e in entries.items():
+        bn  = e[1].split("/")[-1]
+        b   = _tl_bucket(snac, bn.split("-")[0])
+        loc = bn if b is None else "%s/%s" % (b, bn)
+
+        if loc == e[1]:
+            continue
+
+        for d in ("timeline", "local"):
+            fn = "%s/%s/%s" % (snac.basedir, d, e[1])
+
+            if os.path.exists(fn):
+                os.makedirs(os.path.dirname("%s/%s/%s" % (snac.basedir, d, loc)), exist_ok=True)
+                os.rename(fn, "%s/%s/%s" % (snac.basedir, d, loc))
+
+        _tl_cache_drop(snac, e[1])
+
+        entries[md] = (e[0], loc, e[2], e[3])
+        n += 1
+
+    if n:
+        _tl_index_write(snac, entries)
+
+    # delete the emptied buckets
+    for d in ("timeline", "local"):
+        for fn in glob.glob("%s/%s/*/" % (snac.basedir, d)):
+            try:
+                os.rmdir(fn)
+            except:
+                pass
+
+    return n
+
+
+def convert(snac):
+    """ rewrites the stored files of a user in the configured encoding and buckets """
+
+    n = {}
+
+    with timeline_lock(snac):
+        if _tl_segmented(snac):
+            # the records are rewritten compacted
+            timeline_compact(snac)
+        else:
+            n["rebucketed"] = _tl_rebucket(snac)
+
+        for d in ("timeline", "local", "followers", "following", "queue"):
+            compress = d in ("timeline", "local")
+
+            if d in ("timeline", "local"):
+                fns = [x[0] for x in timeline_files(snac, d)]
+            else:
+                fns = glob.glob("%s/%s/*.json" % (snac.basedir, d))
+
+            for fn in fns:
+                try:
+                    if d == "local":
+                        tfn = fn.replace("/local/", "/timeline/")
+
+                        if os.path.exists(tfn):
+                            # relink to the (already converted) timeline file
+                            if not os.path.samefile(fn, tfn):
+                                os.unlink(fn)
+                                os.link(tfn, fn)
+
+                            continue
+
+                    if _convert_file(snac, fn, compress):
+                        n[d] = n.get(d, 0) + 1
+
+                except:
+                    snac.log("cannot convert %s" % fn)
+
+    snac.debug(1, "converted files %s" % n)
+
+    return n
+
+
+def convert_actors(snac):
+    """ rewrites the actor cache (shared by all users) in the configured encoding """
+
+    n = 0
+
+    for fn in glob.glob("%s/actors/*.json" % snac._server.basedir):
+        try:
+            if _convert_file(snac, fn, True):
+                n += 1
+
+        except:
+            snac.log("cannot convert %s" % fn)
+
+    return n
 
 
 def history_put(snac, content, basename):
@@ -0,0 +1,791 @@
+# snac - ActivityPub thing by grunfink
+
+# SQLite implementation of the SNAC.data storage, selected by
+# setting "storage" to "sqlite" in server.json. Everything that
+# is not related to storage is shared with the files implementation.
+
+from SNAC.data import *
+
+import sqlite3
+
+schema = """
+CREATE TABLE IF NOT EXISTS timeline (
+    id          TEXT PRIMARY KEY,
+    tid         TEXT NOT NULL,
+    parent      TEXT,
+    actor       TEXT,
+    local       INTEGER NOT NULL DEFAULT 0,
+    msg         TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timeline_tid ON timeline (tid);
+CREATE INDEX IF NOT EXISTS timeline_local ON timeline (local, tid);
+CREATE INDEX IF NOT EXISTS timeline_parent ON timeline (parent);
+CREATE INDEX IF NOT EXISTS timeline_actor ON timeline (actor);
+
+CREATE TABLE IF NOT EXISTS followers (
+    actor       TEXT PRIMARY KEY,
+    msg         TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS roster (
+    actor       TEXT PRIMARY KEY,
+    inbox       TEXT,
+    shared_inbox TEXT,
+    host        TEXT
+);
+
+CREATE TABLE IF NOT EXISTS following (
+    actor       TEXT PRIMARY KEY,
+    msg         TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS muted (
+    actor       TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS queue (
+    qid         INTEGER PRIMARY KEY AUTOINCREMENT,
+    due         REAL NOT NULL,
+    actor       TEXT,
+    item        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queue_due ON queue (due);
+
+CREATE TABLE IF NOT EXISTS input (
+    iid         INTEGER PRIMARY KEY AUTOINCREMENT,
+    item        TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS input_taken (
+    iid         INTEGER PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS dead (
+    did         INTEGER PRIMARY KEY AUTOINCREMENT,
+    date        REAL NOT NULL,
+    actor       TEXT,
+    item        TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT PRIMARY KEY,
+    value
+);
+"""
+
+# connections, by thread and database file name
+_conns = threading.local()
+
+def _db(snac):
+    """ returns this thread's connection to the user database """
+
+    fn = "%s/snac.db" % snac.basedir
+
+    try:
+        conns = _conns.conns
+    except:
+        conns = {}
+        _conns.conns = conns
+
+    db = conns.get(fn)
+
+    if db is None:
+        db = sqlite3.connect(fn, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(schema)
+
+        conns[fn] = db
+
+    return db
+
+
+def _touch_timeline(db):
+    """ sets the modification time of the timeline (must be in a transaction) """
+
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('timeline_mtime', ?)",
+        (time.time(),))
+
+
+""" followers """
+
+def add_to_followers(snac, actor, msg):
+    """ adds a follower """
+
+    with _db(snac) as db:
+        db.execute("INSERT OR REPLACE INTO followers (actor, msg) VALUES (?, ?)",
+            (actor, json.dumps(msg, separators=compact)))
+
+    snac.debug(2, "saved into followers %s" % actor)
+
+    # the inboxes, from the cached actor
+    obj = cached_actor(snac, actor)
+
+    if obj is None and not snac._server.server_on:
+        # no daemon (i.e. from the command line); request it now
+        status, obj = snac.data.request_actor(snac, actor)
+
+        if status != 200:
+            obj = None
+
+    with _db(snac) as db:
+        _roster_insert(db, roster_entry(actor, obj))
+
+    # not there? it's requested in the background, and the roster updated then
+    if obj is None and snac._server.server_on:
+        actor_refresh_later(snac, actor, True)
+
+    return 201 # created
+
+
+def delete_from_followers(snac, actor, msg):
+    """ deletes a follower """
+
+    with _db(snac) as db:
+        db.execute("DELETE FROM followers WHERE actor = ?", (actor,))
+        db.execute("DELETE FROM roster WHERE actor = ?", (actor,))
+
+    snac.debug(2, "deleted from followers %s" % actor)
+
+    return 200
+
+
+def is_follower(snac, actor):
+    """ returns True if someone is a follower """
+
+    r = _db(snac).execute("SELECT 1 FROM followers WHERE actor = ?", (actor,)).fetchone()
+    ret = r is not None
+
+    snac.debug(2, "check followers %s %s" % (actor, ret))
+
+    return ret
+
+
+def followers(snac):
+    """ iterates the followers """
+
+    for r in _db(snac).execute("SELECT msg FROM followers").fetchall():
+        yield json.loads(r[0])
+
+
+def _roster_insert(db, e):
+    """ inserts a roster entry """
+
+    db.execute("INSERT OR REPLACE INTO roster (actor, inbox, shared_inbox, host) "
+        "VALUES (?, ?, ?, ?)", (e["actor"], e["inbox"], e["sharedInbox"], e["host"]))
+
+
+def roster_refresh(snac, actor):
+    """ updates the roster entry of a follower from its cached actor """
+
+    with _db(snac) as db:
+        if db.execute("SELECT 1 FROM followers WHERE actor = ?", (actor,)).fetchone() is not None:
+            _roster_insert(db, roster_entry(actor, cached_actor(snac, actor)))
+
+
+def follower_roster(snac):
+    """ returns the followers as a list of actor, inbox, sharedInbox and host dicts """
+
+    db = _db(snac)
+
+    # followers not in the roster yet (e.g. migrated) get the inboxes from the cache
+    l = db.execute("SELECT actor FROM followers "
+        "WHERE actor NOT IN (SELECT actor FROM roster)").fetchall()
+
+    if len(l):
+        with db:
+            for (actor,) in l:
+                _roster_insert(db, roster_entry(actor, cached_actor(snac, actor)))
+
+        snac.debug(1, "added to follower roster (%d)" % len(l))
+
+    return [dict(zip(("actor", "inbox", "sharedInbox", "host"), r))
+        for r in db.execute("SELECT actor, inbox, shared_inbox, host FROM roster").fetchall()]
+
+
+""" timeline """
+
+def timeline_mtime(snac):
+    """ returns the modification time of the timeline """
+
+    r = _db(snac).execute("SELECT value FROM meta WHERE key = 'timeline_mtime'").fetchone()
+
+    if r is not None:
+        return r[0]
+    else:
+        return 0
+
+
+def local_mtime(snac):
+    """ returns the modification time of the local timeline """
+
+    return timeline_mtime(snac)
+
+
+def timeline_file_name(snac, id):
+    """ returns the database file name if the id is in the timeline """
+
+    r = _db(snac).execute("SELECT 1 FROM timeline WHERE id = ?", (id,)).fetchone()
+
+    if r is not None:
+        return "%s/snac.db" % snac.basedir
+    else:
+        return None
+
+
+def timeline_index_rebuild(snac):
+    """ rebuilds the timeline indexes """
+
+    with _db(snac) as db:
+        db.execute("REINDEX timeline")
+        n = db.execute("SELECT COUNT(*) FROM timeline").fetchone()[0]
+
+    snac.debug(1, "rebuilt timeline indexes (%d entries)" % n)
+
+    return n
+
+
+def timeline_compact(snac, purge_before=None):
+    """ purges old entries from the timeline (nothing to compact here) """
+
+    if purge_before is not None:
+        with _db(snac) as db:
+            c = db.execute("DELETE FROM timeline WHERE local = 0 AND tid < ?",
+                ("%17.6f" % purge_before,))
+
+            _touch_timeline(db)
+
+        snac.debug(1, "purged from timeline %d entries" % c.rowcount)
+
+
+def get_from_timeline(snac, id):
+    """ returns a message from the timeline """
+
+    r = _db(snac).execute("SELECT msg FROM timeline WHERE id = ?", (id,)).fetchone()
+
+    if r is not None:
+        status, msg = 200, json.loads(r[0])
+    else:
+        status, msg = 404, None
+
+    return status, msg
+
+
+def delete_from_timeline(snac, id):
+    """ deletes a message from the timeline """
+
+    with _db(snac) as db:
+        c = db.execute("DELETE FROM timeline WHERE id = ?", (id,))
+
+        _touch_timeline(db)
+
+    if c.rowcount:
+        snac.debug(1, "deleted from timeline %s" % id)
+        return "%s/snac.db" % snac.basedir
+
+    return None
+
+
+def _insert(db, msg, id, tid, local):
+    """ inserts a message into the timeline table """
+
+    if msg["type"] == "Note":
+        actor = msg.get("attributedTo")
+    else:
+        actor = msg.get("actor")
+
+    db.execute("INSERT INTO timeline (id, tid, parent, actor, local, msg) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (id, tid, msg["_snac"]["parent"], actor, int(local), json.dumps(msg, separators=compact)))
+
+
+def add_to_timeline(snac, msg, id, parent=None, children=None):
+    """ adds a message to the public timeline with the children already there (only them, if stored) """
+
+    with _db(snac) as db:
+        # locked for writing from the start, as the parent
+        # is read and rewritten (maybe by other threads at the same time)
+        if not db.in_transaction:
+            db.execute("BEGIN IMMEDIATE")
+
+        r = db.execute("SELECT msg FROM timeline WHERE id = ?", (id,)).fetchone()
+
+        if r is not None:
+            # already here: only the children it doesn't have are added
+            o_msg = json.loads(r[0])
+            new   = [c for c in (children or []) if c not in o_msg["_snac"]["children"]]
+
+            if len(new):
+                o_msg["_snac"]["children"] += new
+
+                db.execute("UPDATE timeline SET msg = ?, tid = ? WHERE id = ?",
+                    (json.dumps(o_msg, separators=compact), snac.tid(), id))
+                snac.debug(1, "added children to timeline %s" % id)
+            else:
+                snac.debug(1, "refusing to rewrite timeline %s" % id)
+
+            return
+
+        # add the metadata
+        msg["_snac"] = {
+            "children":     list(children or []),
+            "parent":       parent,
+            "liked_by":     [],
+            "announced_by": []
+        }
+
+        local = id.startswith(snac.actor()) or (
+            parent is not None and parent.startswith(snac.actor()))
+
+        _insert(db, msg, id, snac.tid(), local)
+        snac.debug(1, "added to timeline %s" % id)
+
+        if parent is not None:
+            # do we have the parent stored here?
+            r = db.execute("SELECT msg FROM timeline WHERE id = ?", (parent,)).fetchone()
+
+            if r is not None:
+                p_msg = json.loads(r[0])
+
+                if msg["type"] == "Like":
+                    if p_msg["_snac"].get("liked_by") is None:
+                        p_msg["_snac"]["liked_by"] = []
+
+                    p_msg["_snac"]["liked_by"].append(msg["actor"]);
+
+                if msg["type"] == "Announce":
+                    if p_msg["_snac"].get("announced_by") is None:
+                        p_msg["_snac"]["announced_by"] = []
+
+                    p_msg["_snac"]["announced_by"].append(msg["actor"]);
+
+                # append this message to the children list
+                # (unless it was stored with them, as a fetched ancestor)
+                if id not in p_msg["_snac"]["children"]:
+                    p_msg["_snac"]["children"].append(id)
+
+                db.execute("UPDATE timeline SET msg = ? WHERE id = ?",
+                    (json.dumps(p_msg, separators=compact), parent))
+
+                # now move all tree up the timeline
+                seen = set()
+
+                while parent is not None and parent not in seen:
+                    seen.add(parent)
+
+                    db.execute("UPDATE timeline SET tid = ? WHERE id = ?",
+                        (snac.tid(), parent))
+                    snac.debug(1, "updated parent to timeline %s" % parent)
+
+                    r = db.execute("SELECT parent FROM timeline WHERE id = ?",
+                        (parent,)).fetchone()
+
+                    if r is not None:
+                        parent = r[0]
+                    else:
+                        parent = None
+
+        _touch_timeline(db)
+
+
+def _page(snac, where, before, limit):
+    """ iterates a page of timeline messages, newest first """
+
+    # maximum entries to return
+    if limit is None:
+        limit = snac.server["max_timeline_entries"]
+
+    if before is None:
+        before = "~"
+
+    for tid, msg in _db(snac).execute("SELECT tid, msg FROM timeline WHERE %s tid < ? "
+            "ORDER BY tid DESC LIMIT ?" % where, (before, limit)).fetchall():
+        msg = json.loads(msg)
+
+        # store the position, to be used as a cursor
+        msg["_snac"]["tid"] = tid
+
+        yield msg
+
+
+def timeline(snac, before=None, limit=None):
+    """ iterates the entries in the timeline, older than the before tid """
+
+    return _page(snac, "", before, limit)
+
+
+def locals(snac, before=None, limit=None):
+    """ iterates the entries in local, older than the before tid """
+
+    return _page(snac, "local = 1 AND", before, limit)
+
+
+def purge_timeline(snac):
+    """ deletes old entries from the timeline """
+
+    snac.debug(2, "purging timeline for %s" % snac.user["uid"])
+
+    timeline_compact(snac, time.time() - (snac.server["timeline_purge_days"] * 24 * 3600))
+
+
+def purge(snac):
+    """ purges all purgeable things """
+
+    purge_timeline(snac)
+    purge_dead_letters(snac)
+
+
+""" following """
+
+def add_to_following(snac, actor, msg):
+    """ adds someone to the following list """
+
+    with _db(snac) as db:
+        db.execute("INSERT OR REPLACE INTO following (actor, msg) VALUES (?, ?)",
+            (actor, json.dumps(msg, separators=compact)))
+
+    snac.debug(2, "added to following %s" % actor)
+
+    return 201 # created
+
+
+def following(snac, actor):
+    """ returns someone we're following or None """
+
+    r = _db(snac).execute("SELECT msg FROM following WHERE actor = ?", (actor,)).fetchone()
+
+    if r is not None:
+        status, obj = 200, json.loads(r[0])
+    else:
+        status, obj = 404, None
+
+    snac.debug(3, "get from following %s %s" % (actor, status))
+
+    return status, obj
+
+
+def delete_from_following(snac, actor):
+    """ deletes from following """
+
+    with _db(snac) as db:
+        db.execute("DELETE FROM following WHERE actor = ?", (actor,))
+
+    snac.debug(2, "deleted from following %s" % actor)
+
+    return 200
+
+
+def following_list(snac):
+    """ iterates the actors we're following """
+
+    for r in _db(snac).execute("SELECT actor FROM following").fetchall():
+        yield r[0]
+
+
+""" muted """
+
+def mute(snac, actor):
+    """ mutes an actor """
+
+    with _db(snac) as db:
+        db.execute("INSERT OR REPLACE INTO muted (actor) VALUES (?)", (actor,))
+
+    snac.debug(2, "added to muted %s" % actor)
+
+    return 201 # created
+
+
+def unmute(snac, actor):
+    """ unmutes an actor """
+
+    with _db(snac) as db:
+        db.execute("DELETE FROM muted WHERE actor = ?", (actor,))
+
+    snac.debug(2, "deleted from muted %s" % actor)
+
+    return 200
+
+
+def is_muted(snac, actor):
+    """ returns True if an actor is muted """
+
+    r = _db(snac).execute("SELECT 1 FROM muted WHERE actor = ?", (actor,)).fetchone()
+    ret = r is not None
+
+    snac.debug(2, "check muted %s %s" % (actor, ret))
+
+    return ret
+
+
+""" queue """
+
+def enqueue_output(snac, actor, msg, retries=0, inbox=None, shared=False, queued=None):
+    """ enqueue a message to be sent (to inbox, if already known; shared, if it's a shared inbox) """
+
+    if actor == snac.actor():
+        snac.debug(1, "refusing to enqueue a message to ourselves")
+        return
+
+    r = {
+        "type":    "output",
+        "actor":   actor,
+        "object":  msg,
+        "retries": retries,
+        "queued":  queued or time.time()
+    }
+
+    if inbox is not None:
+        r["inbox"] = inbox
+
+    if shared:
+        r["shared"] = True
+
+    due = time.time() + queue_retry_delay(snac, retries)
+
+    with _db(snac) as db:
+        db.execute("INSERT INTO queue (due, actor, item) VALUES (?, ?, ?)",
+            (due, actor, json.dumps(r, separators=compact)))
+
+    snac.debug(2, "enqueue message for %s %d" % (actor, retries))
+
+    queue_wakeup(snac)
+
+
+def queue_next_due(snac, skip=()):
+    """ returns the time the next item of the queue (not in skip) is due, or None """
+
+    for qid, due in _db(snac).execute("SELECT qid, due FROM queue ORDER BY due"):
+        if qid not in skip:
+            return due
+
+    return None
+
+
+def queue_due(snac, skip=()):
+    """ iterates the items of the queue already due (not in skip), in order, as (qid, item) """
+
+    for qid, item in _db(snac).execute("SELECT qid, item FROM queue WHERE due <= ? ORDER BY due",
+            (time.time(),)).fetchall():
+        if qid in skip:
+            continue
+
+        try:
+            m = json.loads(item)
+
+        except ValueError:
+            # out of the way, or it would be due forever
+            snac.log("bad queue item %d, moved to the dead letters" % qid)
+
+            with _db(snac) as db:
+                db.execute("INSERT INTO dead (date, item) VALUES (?, ?)", (time.time(), item))
+                db.execute("DELETE FROM queue WHERE qid = ?", (qid,))
+
+            continue
+
+        yield qid, m
+
+
+def queue_done(snac, qid):
+    """ deletes an item from the queue, once sent """
+
+    with _db(snac) as db:
+        db.execute("DELETE FROM queue WHERE qid = ?", (qid,))
+
+    snac.debug(2, "dequeued %d" % qid)
+
+
+def queue_postpone(snac, qid, due):
+    """ makes an item of the queue due later """
+
+    with _db(snac) as db:
+        db.execute("UPDATE queue SET due = ? WHERE qid = ?", (due, qid))
+
+
+def queue_items(snac):
+    """ iterates the queue without dequeuing, as (due time, item) """
+
+    for due, item in _db(snac).execute("SELECT due, item FROM queue").fetchall():
+        yield due, json.loads(item)
+
+
+def enqueue_input(snac, item):
+    """ stores a received message to be processed; returns its id """
+
+    with _db(snac) as db:
+        c = db.execute("INSERT INTO input (item) VALUES (?)", (json.dumps(item, separators=compact),))
+
+    snac.debug(2, "enqueued input %d" % c.lastrowid)
+
+    return c.lastrowid
+
+
+def input_items(snac):
+    """ iterates the received messages not yet processed, as (id, item) (on startup) """
+
+    # the ones taken before a restart are not taken any more
+    with _db(snac) as db:
+        db.execute("DELETE FROM input_taken")
+
+    for iid, item in _db(snac).execute("SELECT iid, item FROM input ORDER BY iid").fetchall():
+        yield iid, json.loads(item)
+
+
+def input_take(snac, id):
+    """ takes a received message to be processed; returns False if already taken or processed """
+
+    with _db(snac) as db:
+        c = db.execute("INSERT INTO input_taken (iid) SELECT iid FROM input WHERE iid = ? "
+            "AND iid NOT IN (SELECT iid FROM input_taken)", (id,))
+
+    return c.rowcount == 1
+
+
+def input_done(snac, id):
+    """ deletes a received message already processed """
+
+    with _db(snac) as db:
+        db.execute("DELETE FROM input WHERE iid = ?", (id,))
+        db.execute("DELETE FROM input_taken WHERE iid = ?", (id,))
+
+
+def add_to_dead_letters(snac, q_elem, status):
+    """ keeps a queue item that could not be delivered """
+
+    with _db(snac) as db:
+        db.execute("INSERT INTO dead (date, actor, item) VALUES (?, ?, ?)",
+            (time.time(), q_elem["actor"], json.dumps(dict(q_elem, status=status), separators=compact)))
+
+    snac.debug(1, "dead letter for %s" % q_elem["actor"])
+
+
+def dead_letters(snac):
+    """ iterates the dead letters, as (failure time, item) """
+
+    for date, item in _db(snac).execute("SELECT date, item FROM dead ORDER BY did").fetchall():
+        try:
+            yield date, json.loads(item)
+        except ValueError:
+            # a bad queue item
+            pass
+
+
+def purge_dead_letters(snac):
+    """ deletes old dead letters """
+
+    mt = time.time() - snac.server["dead_letter_days"] * 24 * 3600
+
+    with _db(snac) as db:
+        db.execute("DELETE FROM dead WHERE date < ?", (mt,))
+
+
+""" migration """
+
+def migrate(snac):
+    """ imports the data of a user from the layout v1 directories """
+
+    n = {}
+
+    def _load(fn):
+        with open(fn, "rb") as f:
+            return decode(f.read())
+
+    with _db(snac) as db:
+        # the timeline, plus the local entries already purged from it
+        for d in ("timeline", "local"):
+            for fn, loc in timeline_files(snac, d):
+                bn  = loc.split("/")[-1]
+                tid = bn.split("-")[0]
+
+                try:
+                    msg = _load(fn)
+
+                    if msg["type"] == "Create":
+                        id = msg["object"]["id"]
+                    else:
+                        id = msg["id"]
+
+                    local = os.path.exists("%s/local/%s" % (snac.basedir, loc))
+
+                    db.execute("DELETE FROM timeline WHERE id = ?", (id,))
+                    _insert(db, msg, id, tid, local)
+
+                    n[d] = n.get(d, 0) + 1
+
+                except:
+                    snac.log("cannot migrate %s" % fn)
+
+        for d in ("followers", "following"):
+            for fn in glob.glob("%s/%s/*.json" % (snac.basedir, d)):
+                try:
+                    msg = _load(fn)
+
+                    # followers store the Follow; following, the Follow or Accept
+                    if d == "followers" or msg["type"] == "Accept":
+                        actor = msg["actor"]
+                    else:
+                        actor = msg["object"]
+
+                    db.execute("INSERT OR REPLACE INTO %s (actor, msg) VALUES (?, ?)" % d,
+                        (actor, json.dumps(msg, separators=compact)))
+
+                    n[d] = n.get(d, 0) + 1
+
+                except:
+                    snac.log("cannot migrate %s" % fn)
+
+        for fn in glob.glob("%s/muted/*" % snac.basedir):
+            with open(fn) as f:
+                db.execute("INSERT OR REPLACE INTO muted (actor) VALUES (?)",
+                    (f.read().strip(),))
+
+            n["muted"] = n.get("muted", 0) + 1
+
+        for fn in glob.glob("%s/queue/*.json" % snac.basedir):
+            try:
+                item = _load(fn)
+
+                db.execute("INSERT INTO queue (due, actor, item) VALUES (?, ?, ?)",
+                    (float(fn.split("/")[-1][:-5]), item["actor"], json.dumps(item, separators=compact)))
+
+                os.unlink(fn)
+
+                n["queue"] = n.get("queue", 0) + 1
+
+            except:
+                snac.log("cannot migrate %s" % fn)
+
+        for fn in glob.glob("%s/dead/*.json" % snac.basedir):
+            try:
+                item = _load(fn)
+
+                db.execute("INSERT INTO dead (date, actor, item) VALUES (?, ?, ?)",
+                    (float(fn.split("/")[-1][:-5]), item["actor"], json.dumps(item, separators=compact)))
+
+                os.unlink(fn)
+
+                n["dead"] = n.get("dead", 0) + 1
+
+            except:
+                snac.log("cannot migrate %s" % fn)
+
+        _touch_timeline(db)
+
+    return n
+
+
+def convert(snac):
+    """ rewrites the stored messages compacted """
+
+    n = {}
+
+    with _db(snac) as db:
+        for t in ("timeline", "followers", "following", "queue"):
+            col = "item" if t == "queue" else "msg"
+
+            n[t] = db.execute("UPDATE %s SET %s = json(%s) WHERE %s != json(%s)" %
+                (t, col, col, col, col)).rowcount
+
+    _db(snac).execute("VACUUM")
+
+    snac.debug(1, "converted rows %s" % n)
+
+    return n
@@ -419,7 +419,7 @@ def entry(snac, local, msg, seen, level=0):
     return s
 
 
-def timeline(snac, local, seq):
+def timeline(snac, local, seq, older=None):
     """ returns the HTML for a timeline """
 
     t1 = time.time()
@@ -534,6 +534,16 @@ def timeline(snac, local, seq):
 
     s += "</div>\n"
 
+    if older is not None:
+        # link to the next page
+        if local:
+            url = snac.actor("?before=%s" % older)
+        else:
+            url = snac.actor("/admin?before=%s" % older)
+
+        s += "<p class=\"snac-older\"><a href=\"%s\">%s</a></p>\n" % (
+            url, snac.L("Older entries..."))
+
     if local is True:
         # add the history
         s += "<div class=\"snac-history\">\n"
@@ -587,6 +597,23 @@ def request_authorization(snac, headers):
     return logged_in
 
 
+def timeline_page(snac, local, before):
+    """ returns the HTML for a page of the timeline """
+
+    if local:
+        msgs = list(snac.data.locals(snac, before))
+    else:
+        msgs = list(snac.data.timeline(snac, before))
+
+    # if the page is full, there may be older entries
+    if len(msgs) >= snac.server["max_timeline_entries"]:
+        older = msgs[-1]["_snac"].get("tid")
+    else:
+        older = None
+
+    return timeline(snac, local, msgs, older)
+
+
 """ HTTP handlers """
 
 def get_handler(snac, q_path, q_vars, acpt, headers):
@@ -606,7 +633,17 @@ def get_handler(snac, q_path, q_vars, acpt, headers):
         if logged_in is False:
             return 401, "401 Authorization Required", "text/plain"
 
-    if q_path == "/%s" % snac.user["uid"]:
+    # cursor for the older pages of the timelines
+    before = q_vars.get("before", [None])[0]
+
+    if q_path == "/%s" % snac.user["uid"] and before is not None:
+        # older pages are not cached
+        status, body = 200, timeline_page(snac, True, before)
+
+    elif q_path == "/%s/admin" % snac.user["uid"] and before is not None:
+        status, body = 200, timeline_page(snac, False, before)
+
+    elif q_path == "/%s" % snac.user["uid"]:
 
         hf = time.strftime("%Y-%m.html")
 
@@ -620,7 +657,7 @@ def get_handler(snac, q_path, q_vars, acpt, headers):
             snac.debug(1, "serving cached local timeline")
 
         else:
-            status, body = 200, timeline(snac, True, snac.data.locals(snac))
+            status, body = 200, timeline_page(snac, True, None)
 
             snac.data.history_put(snac, body, hf)
 
@@ -636,7 +673,7 @@ def get_handler(snac, q_path, q_vars, acpt, headers):
             snac.debug(1, "serving cached timeline")
 
         else:
-            status, body = 200, timeline(snac, False, snac.data.timeline(snac))
+            status, body = 200, timeline_page(snac, False, None)
 
             snac.data.history_put(snac, body, "_timeline.html")
 
@@ -8,17 +8,43 @@ import OpenSSL
 import base64
 import datetime
 import hashlib
+import time
+import threading
+import collections
+import concurrent.futures
+import os
 
 # PoolManager
 pm = urllib3.PoolManager(retries=urllib3.Retry(total=0, connect=0))
 
-def request(snac, method, url, headers={}, fields=None, body=None):
-    """ Does an HTTP request """
+# the parts of a Signature header, as name="value"
+re_sig_param = re.compile("([a-zA-Z]+)=\"([^\"]*)\"")
+
+# signing contexts, by user actor, as (secret PEM, key object, Signature header prefix)
+_signers = {}
+
+# public keys, by keyId, as (PEM, X509 wrap)
+_pubkeys  = collections.OrderedDict()
+
+# signatures already verified, as (keyId, signature, signed string): expiry time
+_verified = collections.OrderedDict()
+
+_key_lock  = threading.Lock()
+_key_stats = { "key_hits": 0, "key_misses": 0, "sig_hits": 0, "sig_misses": 0 }
+
+# the crypto pool (OpenSSL releases the GIL, so threads run in parallel)
+_crypto_pool  = None
+_crypto_lock  = threading.Lock()
+_crypto_stats = { "queued": 0, "running": 0, "done": 0, "wait": 0.0, "time": 0.0 }
+
+def request(snac, method, url, headers={}, fields=None, body=None, rheaders=None):
+    """ Does an HTTP request (storing the response headers into rheaders) """
 
     # add the User Agent
     headers["User-Agent"] = snac.user_agent
 
-    status = 500
+    # network errors (timeouts, unreachable hosts...)
+    status = 599
 
     try:
         # why this?
@@ -30,14 +56,190 @@ def request(snac, method, url, headers={}, fields=None, body=None):
             rq = SNAC.http.pm.request(method, url, headers=headers, body=body)
 
         status, body = rq.status, rq.data
+
+        if rheaders is not None:
+            for k, v in rq.headers.items():
+                rheaders[k.lower()] = v
+
     except:
         pass
 
     return status, body
 
 
-def request_signed(snac, method, url, msg=None):
-    """ Does an HTTP request, signed """
+def _crypto_run(f, args, t):
+    """ runs a crypto operation in the pool, accounting its times """
+
+    s = time.time()
+
+    with _crypto_lock:
+        _crypto_stats["queued"]  -= 1
+        _crypto_stats["running"] += 1
+        _crypto_stats["wait"]    += s - t
+
+    try:
+        return f(*args)
+
+    finally:
+        with _crypto_lock:
+            _crypto_stats["running"] -= 1
+            _crypto_stats["done"]    += 1
+            _crypto_stats["time"]    += time.time() - s
+
+
+def crypto(snac, f, *args):
+    """ runs a crypto operation (sign or verify) in the crypto pool """
+
+    global _crypto_pool
+
+    n = snac.server["crypto_threads"] or os.cpu_count() or 1
+
+    # no pool? run it here
+    if n < 0:
+        return f(*args)
+
+    with _crypto_lock:
+        if _crypto_pool is None:
+            _crypto_pool = concurrent.futures.ThreadPoolExecutor(n, "crypto")
+
+        _crypto_stats["queued"] += 1
+
+    return _crypto_pool.submit(_crypto_run, f, args, time.time()).result()
+
+
+def crypto_stats():
+    """ returns the crypto pool statistics """
+
+    with _crypto_lock:
+        d = dict(_crypto_stats)
+
+    # average milliseconds waiting and working
+    d["avg_wait"] = 1000 * d["wait"] / d["done"] if d["done"] else 0.0
+    d["avg_time"] = 1000 * d["time"] / d["done"] if d["done"] else 0.0
+
+    return d
+
+
+def _signer(snac):
+    """ returns the signing context of a user """
+
+    actor = snac.actor()
+    sc    = _signers.get(actor)
+
+    # not yet built, or the key changed
+    if sc is None or sc[0] != snac.key["secret"]:
+        pk = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, snac.key["secret"])
+
+        key_name = actor + "#main-key"
+
+        prefix  = "keyId=\"" + key_name + "\","
+        prefix += "algorithm=\"rsa-sha256\","
+        prefix += "headers=\"(request-target) host digest date\","
+
+        sc = (snac.key["secret"], pk, prefix)
+        _signers[actor] = sc
+
+    return sc
+
+
+def _verifier(snac, keyId, pem):
+    """ returns the X509 wrap of the public key of keyId """
+
+    with _key_lock:
+        v = _pubkeys.get(keyId)
+
+        if v is not None and v[0] == pem:
+            _pubkeys.move_to_end(keyId)
+            _key_stats["key_hits"] += 1
+            return v[1]
+
+        _key_stats["key_misses"] += 1
+
+    # get the public key and its X509 wrap
+    pk   = OpenSSL.crypto.load_publickey(OpenSSL.crypto.FILETYPE_PEM, pem)
+    x509 = OpenSSL.crypto.X509()
+    x509.set_pubkey(pk)
+
+    with _key_lock:
+        _pubkeys[keyId] = (pem, x509)
+        _pubkeys.move_to_end(keyId)
+
+        while len(_pubkeys) > snac.server["key_cache_entries"]:
+            _pubkeys.popitem(last=False)
+
+    return x509
+
+
+def _is_verified(snac, k):
+    """ checks if a signature was recently verified """
+
+    with _key_lock:
+        t = _verified.get(k)
+
+        if t is not None and t > time.time():
+            _key_stats["sig_hits"] += 1
+            return True
+
+        _key_stats["sig_misses"] += 1
+
+    return False
+
+
+def _set_verified(snac, k):
+    """ remembers a verified signature for a while """
+
+    with _key_lock:
+        _verified[k] = time.time() + 60 * snac.server["signature_cache_minutes"]
+        _verified.move_to_end(k)
+
+        while len(_verified) > snac.server["signature_cache_entries"]:
+            _verified.popitem(last=False)
+
+
+def key_forget(snac, actor, obj):
+    """ forgets the cached public key of an actor, if it changed """
+
+    keyIds = set([actor])
+    pem    = None
+
+    try:
+        keyIds.add(obj["publicKey"]["id"].replace("#main-key", ""))
+        pem = obj["publicKey"]["publicKeyPem"]
+    except:
+        pass
+
+    with _key_lock:
+        gone = set()
+
+        for keyId in keyIds:
+            v = _pubkeys.get(keyId)
+
+            if v is not None and v[0] != pem:
+                del _pubkeys[keyId]
+                gone.add(keyId)
+
+        # and the signatures verified with it
+        if gone:
+            for k in [k for k in _verified if k[0] in gone]:
+                del _verified[k]
+
+    if gone:
+        snac.debug(1, "public key changed for %s" % actor)
+
+
+def signature_cache_stats():
+    """ returns the key and verified signature cache statistics """
+
+    with _key_lock:
+        d = dict(_key_stats)
+        d["keys"]       = len(_pubkeys)
+        d["signatures"] = len(_verified)
+
+    return d
+
+
+def request_signed(snac, method, url, msg=None, headers=None, rheaders=None):
+    """ Does an HTTP request, signed (with optional headers) """
 
     if msg is not None:
         body = json.dumps(msg)
@@ -73,19 +275,14 @@ def request_signed(snac, method, url, msg=None):
     s += "digest: " + digest + "\n"
     s += "date: " + date
 
-    # build a key object
-    pk = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, snac.key["secret"])
+    # the key object and the header are already built
+    secret, pk, prefix = _signer(snac)
 
-    b = OpenSSL.crypto.sign(pk, s, "sha256")
+    b = crypto(snac, OpenSSL.crypto.sign, pk, s.encode(), "sha256")
     sig_b64 = base64.b64encode(b).decode()
 
     # build the signature header
-    key_name = snac.actor() + "#main-key"
-
-    signature = "keyId=\"" + key_name + "\","
-    signature += "algorithm=\"rsa-sha256\","
-    signature += "headers=\"(request-target) host digest date\","
-    signature += "signature=\"" + sig_b64 + "\""
+    signature = prefix + "signature=\"" + sig_b64 + "\""
 
     if method == "POST":
         # send the POST
@@ -97,14 +294,20 @@ def request_signed(snac, method, url, msg=None):
             "User-Agent":       snac.user_agent
             }, body=body)
     else:
-        # send the GET
-        status, data = snac.http.request(snac, "GET", url, headers={
+        h = {
             "Accept":           "application/activity+json",
             "Date":             date,
             "Signature":        signature,
             "Digest":           digest,
             "User-Agent":       snac.user_agent
-            })
+            }
+
+        # e.g. the conditional ones
+        if headers is not None:
+            h.update(headers)
+
+        # send the GET
+        status, data = snac.http.request(snac, "GET", url, headers=h, rheaders=rheaders)
 
     try:
         reply = data.decode()
@@ -138,15 +341,16 @@ def check_signature(snac, q_path, payload, headers):
 
     sig_hdr = headers["signature"]
 
+    # parse the header parts
+    sig = dict(re_sig_param.findall(sig_hdr))
+
     # get the keyId URL
-    x = re.match(".*keyId=\"([^\"]+)\"", sig_hdr)
+    keyId = sig.get("keyId")
 
-    if x is None:
+    if keyId is None:
         snac.debug(1, "checksig cannot extract keyId from header '%s'" % sig_hdr)
         return 400
 
-    keyId = x.group(1)
-
     # take for granted if on this same instance,
     # we're not going to lie to ourselves
     if keyId.startswith(snac._server.base_url()):
@@ -173,14 +377,12 @@ def check_signature(snac, q_path, payload, headers):
         return 400
 
     # get the signature headers
-    x = re.match(".*headers=\"([^\"]+)\"", sig_hdr)
+    hdr_list = sig.get("headers")
 
-    if x is None:
+    if hdr_list is None:
         snac.debug(1, "checksig cannot extract headers from header '%s'" % sig_hdr)
         return 400
 
-    hdr_list = x.group(1)
-
     # calculate the string to be signed
     sig_str = ""
 
@@ -191,25 +393,35 @@ def check_signature(snac, q_path, payload, headers):
         if h == "(request-target)":
             sig_str += "%s: post %s" % (h, q_path)
         else:
-            sig_str += "%s: %s" % (h, headers[h])
+            sig_str += "%s: %s" % (h, headers.get(h))
 
     # get the signature itself
-    x = re.match(".*signature=\"([^\"]+)\"", sig_hdr)
+    sig_b64 = sig.get("signature")
 
-    if x is None:
+    if sig_b64 is None:
         snac.debug(1, "checksig cannot extract signature from header '%s'" % sig_hdr)
         return 400
 
-    sig_b64 = x.group(1)
+    # already verified? (e.g. a delivery retried by the other side)
+    k = (keyId, sig_b64, sig_str)
+
+    if _is_verified(snac, k):
+        snac.debug(2, "checksig signature already verified for %s" % keyId)
+        return 200
+
     sig_bin = base64.b64decode(sig_b64)
 
-    # get the public key and its X509 wrap
-    pk      = OpenSSL.crypto.load_publickey(OpenSSL.crypto.FILETYPE_PEM, pem)
-    x509    = OpenSSL.crypto.X509()
-    x509.set_pubkey(pk)
+    # get the (cached) X509 wrap of the public key
+    try:
+        x509 = _verifier(snac, keyId, pem)
+    except:
+        snac.debug(1, "checksig bad PEM from key %s" % keyId)
+        return 400
 
     try:
-        OpenSSL.crypto.verify(x509, sig_bin, sig_str, "sha256")
+        crypto(snac, OpenSSL.crypto.verify, x509, sig_bin, sig_str.encode(), "sha256")
+
+        _set_verified(snac, k)
 
     except:
         snac.debug(1, "checksig OpenSSL verify error")
@@ -194,12 +194,76 @@ def helper_thread(snacsrv):
 
     snacsrv.log("subthread start")
 
+    # time of the last storage compaction
+    compacted = time.time()
+
     while snacsrv.server_on:
+        seq = snacsrv.queue_seq
+
+        # look at least every 30 seconds, as other processes
+        # (e.g. the command line) can also enqueue messages
+        next_due = time.time() + 30
+
         # iterate all users and dispatch their queues
         for snac in snacsrv.users():
             snac.activitypub.queue(snac)
 
-        time.sleep(3)
+            due = snac.data.queue_next_due(snac, snac.activitypub.delivery_taken(snac))
+
+            if due is not None:
+                next_due = min(next_due, due)
+
+        # compact the timelines (if needed) and refresh the
+        # actors about to expire every 10 minutes
+        if compacted + 600 < time.time():
+            for snac in snacsrv.users():
+                snac.data.timeline_compact(snac)
+                snac.data.actor_refresh_proactive(snac)
+
+            compacted = time.time()
+
+            snacsrv.debug(1, "timeline cache: %(hits)d hits, %(misses)d misses, "
+                "%(entries)d entries, %(bytes)d bytes" % snacsrv.data.timeline_cache_stats())
+
+            snacsrv.debug(1, "actor cache: %(hits)d hits, %(misses)d misses, "
+                "%(stale)d stale, %(negative)d negative, %(refreshes)d refreshes, "
+                "%(failures)d failures, %(entries)d entries, %(failing)d failing, "
+                "%(queued)d queued" % snacsrv.data.actor_cache_stats(snacsrv))
+
+            snacsrv.debug(1, "object cache: %(hits)d hits, %(revalidated)d revalidated, "
+                "%(misses)d misses, %(entries)d entries" % snacsrv.data.object_cache_stats(snacsrv))
+
+            snacsrv.debug(1, "delivery: %(in_flight)d in flight, %(queued)d queued, "
+                "%(completed)d completed, %(failed)d failed, %(workers)d workers, "
+                "%(saved)d saved by shared inboxes, %(open)d hosts down" %
+                snacsrv.activitypub.delivery_stats(snacsrv))
+
+            snacsrv.debug(1, "signature cache: %(key_hits)d key hits, %(key_misses)d key misses, "
+                "%(sig_hits)d verified hits, %(sig_misses)d verified misses, %(keys)d keys, "
+                "%(signatures)d signatures" % SNAC.http.signature_cache_stats())
+
+            snacsrv.debug(1, "seen activities: %(hits)d duplicates, %(misses)d new, "
+                "%(entries)d entries" % snacsrv.data.seen_stats(snacsrv))
+
+            snacsrv.debug(1, "input: %(in_flight)d in flight, %(queued)d queued, "
+                "%(processed)d processed, %(failed)d failed, %(workers)d workers" %
+                snacsrv.activitypub.input_stats(snacsrv))
+
+            snacsrv.debug(1, "in_reply_to: %(in_flight)d in flight, %(queued)d queued, "
+                "%(fetched)d fetched, %(failed)d failed" % snacsrv.activitypub.ancestor_stats(snacsrv))
+
+            snacsrv.debug(1, "crypto: %(queued)d queued, %(running)d running, %(done)d done, "
+                "%(avg_wait).2f ms avg wait, %(avg_time).2f ms avg time" % SNAC.http.crypto_stats())
+
+            for host, (state, failures, until) in snacsrv.activitypub.host_health(snacsrv).items():
+                snacsrv.debug(2, "host %s: %s, %d failures" % (host, state, failures))
+
+        next_due = min(next_due, compacted + 600)
+
+        # sleep until the next message is due or a new one is enqueued
+        with snacsrv.queue_cond:
+            if snacsrv.queue_seq == seq and snacsrv.server_on:
+                snacsrv.queue_cond.wait(max(0, next_due - time.time()))
 
     snacsrv.log("subthread stop")
 
@@ -225,6 +289,11 @@ def run(snacsrv, address=None, port=0):
 
     snacsrv.server_on = True
 
+    # process what was received but not processed before
+    # (before accepting new messages)
+    for snac in snacsrv.users():
+        snac.activitypub.input_recover(snac)
+
     # create the helper thread
     ht = threading.Thread(target=helper_thread, args=(snacsrv,))
     ht.start()
@@ -242,5 +311,9 @@ def run(snacsrv, address=None, port=0):
 
     snacsrv.server_on = False
 
+    # wake up the helper thread, so it ends
+    with snacsrv.queue_cond:
+        snacsrv.queue_cond.notify_all()
+
     server.server_close()
     snacsrv.log("httpd stop %s:%s" % (address, port))
@@ -178,7 +178,7 @@ def adduser(snacsrv, uid=None):
         print("ERROR: cannot create directory %s" % udir)
         return False
 
-    for sd in ("actors", "archive", "followers", "following",
+    for sd in ("archive", "followers", "following",
                "local", "muted", "queue", "static", "timeline", "history"):
         sd = "%s/%s" % (udir, sd)
 